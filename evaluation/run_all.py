@@ -31,8 +31,8 @@ def find_free_port():
 
 def wait_for_server(url, timeout=15):
     """Poll the server until it responds or timeout."""
-    deadline = time.time() + timeout
-    while time.time() < deadline:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         try:
             resp = requests.get(url, timeout=2)
             if resp.status_code == 200:
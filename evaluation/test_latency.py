@@ -57,21 +57,23 @@ def run(base_url, tmp_dir, results_dir):
         requests.get(url)
 
         for _ in range(REQUESTS_PER_SIZE):
-            start = time.perf_counter()
+            start = time.perf_counter_ns()
             resp = requests.get(url)
-            elapsed = (time.perf_counter() - start) * 1000  # ms
+            elapsed = (time.perf_counter_ns() - start) / 1e6  # ms
             assert resp.status_code == 200, f"Got {resp.status_code} for {fname}"
             times.append(elapsed)
 
         avg = statistics.mean(times)
         std = statistics.stdev(times) if len(times) > 1 else 0.0
+        pct = statistics.quantiles(times, n=100, method="inclusive")
 
         labels.append(label)
         avg_times.append(avg)
         std_times.append(std)
         sizes_kb.append(FILE_SIZES[label] / 1024)
 
-        print(f"  {label:>6s}: avg={avg:.2f} ms  std={std:.2f} ms")
+        print(f"  {label:>6s}: avg={avg:.2f} ms  std={std:.2f} ms  "
+              f"p50={pct[49]:.2f} ms  p95={pct[94]:.2f} ms  p99={pct[98]:.2f} ms")
 
     # Plot
     fig, ax = plt.subplots(figsize=(8, 5))
@@ -0,0 +1,8 @@
+"""Text/binary limits shared by server.py and mcp_server.py.
+
+Both servers classify and truncate files with these values, so the viewer
+and the MCP tools always agree on what a file contains.
+"""
+
+SNIFF_BYTES = 64 * 1024  # bytes inspected to tell text from binary
+MAX_TEXT_BYTES = 5 * 1024 * 1024  # text files are truncated beyond this
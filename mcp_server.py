@@ -7,17 +7,31 @@ Supports PDF/LaTeX documents and code files with a web-based UI.
 """
 
 import asyncio
+import atexit
 import json
 import logging
 import mimetypes
+import mmap
 import os
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
+try:
+    import orjson
+except ImportError:  # optional: parses large state files straight from an mmap
+    orjson = None  # type: ignore[assignment]
 
+try:
+    from watchfiles import awatch
+except ImportError:  # optional: event-driven waits in get_selection
+    awatch = None  # type: ignore[assignment]
 
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
@@ -26,10 +40,14 @@ from mcp.types import (
     TextContent,
     Tool,
     Prompt,
+    PromptArgument,
     PromptMessage,
     GetPromptResult,
 )
 
+import state_file
+from file_limits import MAX_TEXT_BYTES, SNIFF_BYTES
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, stream=sys.stderr)
 logger = logging.getLogger("context-viewer")
@@ -38,9 +56,32 @@ logger = logging.getLogger("context-viewer")
 app = Server("context-viewer")
 
 # State management
-STATE_FILE = Path.home() / ".context-viewer-state.json"
-HTTP_SERVER_PROCESS = None
+HTTP_SERVER_PROCESS: subprocess.Popen | None = None
 HTTP_PORT = 8765
+HTTP_LOG_FILE = Path("/tmp/contextviewermcp-server.log")  # same log as the CLI
+STATE_WRITE_DELAY = 0.02  # seconds, coalesces bursts of tool-driven writes
+STATE_POLL_INTERVAL = 0.5  # seconds, used when watchfiles is unavailable
+STATE_MMAP_MIN_BYTES = 64 * 1024  # larger state files are parsed straight from an mmap
+
+
+def _read_state_file(size: int) -> Any:
+    """Parse the state file, mapping it instead of copying it when large.
+
+    orjson accepts any buffer, so big selections are decoded straight from
+    the page cache; the stdlib fallback needs bytes and always reads.
+    """
+    if orjson is None or size < STATE_MMAP_MIN_BYTES:
+        return state_file.loads(state_file.STATE_FILE.read_bytes())
+    fd = os.open(state_file.STATE_FILE, os.O_RDONLY)
+    try:
+        with mmap.mmap(fd, 0, prot=mmap.PROT_READ) as mm:
+            if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+    finally:
+        os.close(fd)
+
 
 # Resolve the directory to serve from --serve-dir arg (or cwd as fallback)
 def _resolve_serve_dir() -> Path:
@@ -53,57 +94,238 @@ def _resolve_serve_dir() -> Path:
     return Path.cwd()
 
 BASE_DIR = _resolve_serve_dir()
+_BASE_RESOLVED = BASE_DIR.resolve()
 
+# A queued change to the state: mutates the dict it is given in place. Updates
+# run against a shallow copy, so they must replace nested values, not mutate them.
+StateUpdate = Callable[[dict[str, Any]], object]
 
-def get_state() -> dict[str, Any]:
-    """Read the current state from the state file."""
-    if not STATE_FILE.exists():
-        return {}
+# Updates queued by schedule_state_update() and not yet handed to the writer
+_pending_updates: list[StateUpdate] = []
+_pending_flush: asyncio.TimerHandle | None = None
+
+# Batches handed to the writer whose rename has not happened yet
+_inflight_batches: list[list[StateUpdate]] = []
+
+# Writes run here, in submission order, so fsync never blocks the event loop
+_STATE_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+
+# Guards _STATE_CACHE and _inflight_batches, which the writer thread updates
+_state_mem_lock = threading.Lock()
+
+_REQUIRED_SELECTION_KEYS = frozenset(
+    {"file_path", "start_line", "end_line", "selected_text", "timestamp"}
+)
+
+# Last parsed state, keyed by the state file's (mtime_ns, size, inode)
+_STATE_CACHE: dict[str, Any] = {"key": None, "value": {}}
+
+
+def _state_cache_key(st: os.stat_result) -> tuple[int, int, int]:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _prefetch_state_file() -> None:
+    """Ask the kernel to start reading the state file before the first get_state()."""
+    if not hasattr(os, "posix_fadvise"):  # e.g. macOS, Windows
+        return
+    try:
+        fd = os.open(state_file.STATE_FILE, os.O_RDONLY)
+    except OSError:
+        return
     try:
-        with open(STATE_FILE, "r") as f:
-            state = json.load(f)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
-        # Validate state structure
-        if not isinstance(state, dict):
-            logger.warning("Invalid state file format, resetting")
-            return {}
 
-        # Validate selection structure if present
-        if "selection" in state:
-            sel = state["selection"]
-            required_fields = ["file_path", "start_line", "end_line", "selected_text", "timestamp"]
-            if not all(field in sel for field in required_fields):
-                logger.warning("Invalid selection structure, removing")
-                state.pop("selection", None)
-                save_state(state)
+_prefetch_state_file()
 
-        return state
+
+def _load_state_file(size: int) -> dict[str, Any]:
+    """Parse and validate the state file; a corrupted file is backed up and reset."""
+    try:
+        state = _read_state_file(size)
     except json.JSONDecodeError as e:
         logger.error(f"Corrupted state file: {e}, resetting")
         # Backup corrupted file
-        backup_path = STATE_FILE.with_suffix(".json.backup")
-        if STATE_FILE.exists():
-            STATE_FILE.rename(backup_path)
+        backup_path = state_file.STATE_FILE.with_suffix(".json.backup")
+        if state_file.STATE_FILE.exists():
+            state_file.STATE_FILE.rename(backup_path)
             logger.info(f"Backed up corrupted state to {backup_path}")
         return {}
-    except Exception as e:
-        logger.error(f"Failed to read state: {e}")
+
+    # Validate state structure
+    if not isinstance(state, dict):
+        logger.warning("Invalid state file format, resetting")
         return {}
 
+    # Validate selection structure if present; the next write persists the fix
+    if "selection" in state:
+        sel = state["selection"]
+        if not isinstance(sel, dict) or not _REQUIRED_SELECTION_KEYS.issubset(sel):
+            logger.warning("Invalid selection structure, removing")
+            state.pop("selection", None)
+    return state
+
 
-def save_state(state: dict[str, Any]) -> None:
-    """Save state to the state file atomically."""
+def _cached_state() -> dict[str, Any]:
+    """Return a shallow copy of the on-disk state; caller holds _state_mem_lock."""
     try:
-        # Write to temporary file first for atomic operation
-        temp_file = STATE_FILE.with_suffix(".json.tmp")
-        with open(temp_file, "w") as f:
-            json.dump(state, f, indent=2)
+        st = state_file.STATE_FILE.stat()
+    except FileNotFoundError:
+        return {}
+    key = _state_cache_key(st)
+    if _STATE_CACHE["key"] != key:
+        try:
+            _STATE_CACHE["value"] = _load_state_file(st.st_size)
+        except Exception as e:
+            logger.error(f"Failed to read state: {e}")
+            return {}
+        _STATE_CACHE["key"] = key
+    return dict(_STATE_CACHE["value"])
 
-        # Atomic rename (overwrites existing file)
-        temp_file.replace(STATE_FILE)
+
+def get_state() -> dict[str, Any]:
+    """Read the current state, including updates that are not written yet.
+
+    The parsed state is cached until the file changes on disk, so repeated
+    reads cost a single stat(). Callers get a shallow copy: top-level keys
+    may be reassigned freely, but nested values must not be mutated in place.
+    """
+    with _state_mem_lock:
+        state = _cached_state()
+        for batch in _inflight_batches:
+            for update in batch:
+                update(state)
+    for update in _pending_updates:
+        update(state)
+    return state
+
+
+def _discard_batch(batch: list[StateUpdate]) -> None:
+    for i, inflight in enumerate(_inflight_batches):
+        if inflight is batch:
+            del _inflight_batches[i]
+            return
+
+
+def _write_batch(batch: list[StateUpdate]) -> None:
+    """Apply batch to a fresh read of the state file and replace it atomically.
+
+    The whole read-modify-write holds the lock shared with server.py, so
+    changes the browser saved after the updates were queued are kept.
+    """
+    try:
+        with state_file.lock():
+            try:
+                state = _load_state_file(state_file.STATE_FILE.stat().st_size)
+            except FileNotFoundError:
+                state = {}
+            for update in batch:
+                update(state)
+            # Write to temporary file first for atomic operation
+            temp_file = state_file.write_temp(state_file.dumps(state))
+
+            # The rename keeps inode, size and mtime, so this keys the new file
+            key = _state_cache_key(os.stat(temp_file))
+            with _state_mem_lock:
+                # Atomic rename (overwrites existing file)
+                temp_file.replace(state_file.STATE_FILE)
+                _STATE_CACHE["key"] = key
+                _STATE_CACHE["value"] = state
+                _discard_batch(batch)
+        state_file.fsync_dir(state_file.STATE_FILE.parent)
         logger.debug("State saved successfully")
     except Exception as e:
         logger.error(f"Failed to save state: {e}")
+        with _state_mem_lock:
+            _discard_batch(batch)
+
+
+def _take_pending_batch() -> list[StateUpdate] | None:
+    global _pending_updates, _pending_flush
+    if _pending_flush is not None:
+        _pending_flush.cancel()
+        _pending_flush = None
+    if not _pending_updates:
+        return None
+    with _state_mem_lock:
+        batch = _pending_updates
+        _pending_updates = []
+        _inflight_batches.append(batch)
+    return batch
+
+
+def schedule_state_update(update: StateUpdate) -> None:
+    """Apply update to the state file shortly, coalescing a burst into one write.
+
+    The write (including its fsyncs) runs on a background thread against a
+    fresh read of the file; until it lands, get_state() applies the update
+    on top of what is on disk.
+    """
+    global _pending_flush
+    _pending_updates.append(update)
+    if _pending_flush is None:
+        _pending_flush = asyncio.get_running_loop().call_later(
+            STATE_WRITE_DELAY, _flush_state_in_background
+        )
+
+
+def _flush_state_in_background() -> None:
+    batch = _take_pending_batch()
+    if batch is not None:
+        _STATE_WRITER.submit(_write_batch, batch)
+
+
+def update_state(update: StateUpdate) -> None:
+    """Apply update to the state file now, waiting for it to be durable."""
+    _pending_updates.append(update)
+    flush_state()
+
+
+def flush_state() -> None:
+    """Write any updates queued by schedule_state_update() and wait for them."""
+    batch = _take_pending_batch()
+    if batch is None:
+        return
+    try:
+        future = _STATE_WRITER.submit(_write_batch, batch)
+    except RuntimeError:  # the writer is already shut down at interpreter exit
+        _write_batch(batch)
+    else:
+        future.result()
+
+
+# Don't lose a coalesced write if the process exits without going through main()
+atexit.register(flush_state)
+
+
+async def _state_file_changes(stop_event: asyncio.Event) -> AsyncGenerator[None, None]:
+    """Yield whenever the state file may have changed.
+
+    Uses filesystem notifications via watchfiles when installed (with a
+    periodic wake-up as a safety net), otherwise falls back to polling.
+    """
+    if awatch is None:
+        while not stop_event.is_set():
+            await asyncio.sleep(STATE_POLL_INTERVAL)
+            yield
+        return
+
+    # Watch the parent directory: state writes replace the file via rename,
+    # which would drop a watch placed on the file itself.
+    async for _ in awatch(
+        state_file.STATE_FILE.parent,
+        watch_filter=lambda _change, path: Path(path).name == state_file.STATE_FILE.name,
+        recursive=False,
+        stop_event=stop_event,
+        rust_timeout=5000,
+        yield_on_timeout=True,
+    ):
+        yield
 
 
 def start_http_server() -> subprocess.Popen:
@@ -114,15 +336,27 @@ def start_http_server() -> subprocess.Popen:
 
     logger.info(f"Starting HTTP server on port {HTTP_PORT}")
     server_script = Path(__file__).parent / "server.py"
-    HTTP_SERVER_PROCESS = subprocess.Popen(
-        [sys.executable, str(server_script), str(HTTP_PORT), "--serve-dir", str(BASE_DIR)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
+    # Send output to a log file rather than pipes nobody reads: once a pipe
+    # buffer fills up, the server would block on its next print()
+    with open(HTTP_LOG_FILE, "a") as log_file:
+        HTTP_SERVER_PROCESS = subprocess.Popen(
+            [sys.executable, str(server_script), str(HTTP_PORT), "--serve-dir", str(BASE_DIR)],
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            start_new_session=True,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+        )
+
+    logger.info(f"HTTP server started at http://localhost:{HTTP_PORT} (log: {HTTP_LOG_FILE})")
+    server_state = {"server_url": f"http://localhost:{HTTP_PORT}", "server_pid": HTTP_SERVER_PROCESS.pid}
+
+    def _reset(state: dict[str, Any]) -> None:
+        state.clear()
+        state.update(server_state)
 
-    logger.info(f"HTTP server started at http://localhost:{HTTP_PORT}")
-    save_state({"server_url": f"http://localhost:{HTTP_PORT}", "server_pid": HTTP_SERVER_PROCESS.pid})
+    update_state(_reset)
 
     return HTTP_SERVER_PROCESS
 
@@ -140,13 +374,17 @@ def stop_http_server() -> None:
         HTTP_SERVER_PROCESS = None
 
 
+def _resolve_within_base(path: str) -> Path:
+    """Resolve a project-relative path, refusing anything outside BASE_DIR."""
+    full_path = (_BASE_RESOLVED / path.lstrip("/")).resolve()
+    if not full_path.is_relative_to(_BASE_RESOLVED):
+        raise ValueError("Access denied: path outside base directory")
+    return full_path
+
+
 def list_files(path: str = "") -> list[dict[str, Any]]:
     """List files in a directory."""
-    full_path = BASE_DIR / path.lstrip("/")
-    full_path = full_path.resolve()
-
-    if not str(full_path).startswith(str(BASE_DIR)):
-        raise ValueError("Access denied: path outside base directory")
+    full_path = _resolve_within_base(path)
 
     if not full_path.exists():
         raise FileNotFoundError(f"Path not found: {path}")
@@ -154,16 +392,19 @@ def list_files(path: str = "") -> list[dict[str, Any]]:
     if not full_path.is_dir():
         raise ValueError(f"Not a directory: {path}")
 
+    # scandir's DirEntry caches type info from the directory read, avoiding
+    # separate stat() calls per entry for is_dir()/is_file()
+    with os.scandir(full_path) as it:
+        entries = sorted((e for e in it if not e.name.startswith(".")), key=lambda e: e.name)
+
+    rel_dir = full_path.relative_to(_BASE_RESOLVED)
     items = []
-    for item in sorted(full_path.iterdir()):
-        if item.name.startswith("."):
-            continue
-        rel_path = item.relative_to(BASE_DIR)
+    for entry in entries:
         items.append({
-            "name": item.name,
-            "path": str(rel_path),
-            "is_dir": item.is_dir(),
-            "size": item.stat().st_size if item.is_file() else 0,
+            "name": entry.name,
+            "path": str(rel_dir / entry.name),
+            "is_dir": entry.is_dir(),
+            "size": entry.stat().st_size if entry.is_file() else 0,
         })
 
     return items
@@ -171,42 +412,75 @@ def list_files(path: str = "") -> list[dict[str, Any]]:
 
 def read_file(path: str) -> dict[str, Any]:
     """Read file content."""
-    full_path = BASE_DIR / path.lstrip("/")
-    full_path = full_path.resolve()
-
-    if not str(full_path).startswith(str(BASE_DIR)):
-        raise ValueError("Access denied: path outside base directory")
+    full_path = _resolve_within_base(path)
 
     if not full_path.is_file():
         raise ValueError(f"Not a file: {path}")
 
     mime_type, _ = mimetypes.guess_type(str(full_path))
-
-    with open(full_path, "rb") as f:
-        raw = f.read()
-
-    is_text = b"\x00" not in raw
+    size = full_path.stat().st_size
     content = None
+    truncated = False
 
-    if is_text:
-        content = raw.decode("utf-8", errors="replace")
+    with open(full_path, "rb") as f:
+        # Sniff a small header so binary files are never loaded in full
+        head = f.read(SNIFF_BYTES)
+        is_text = b"\x00" not in head
+        if is_text:
+            raw = head + f.read(max(0, MAX_TEXT_BYTES - len(head)))
+            truncated = size > len(raw)
+            content = raw.decode("utf-8", errors="replace")
 
     return {
         "content": content,
         "mime_type": mime_type,
         "is_text": is_text,
-        "size": len(raw),
+        "size": size,
+        "truncated": truncated,
         "path": path,
     }
 
 
+def _run_with_output_tail(cmd: list[str], cwd: Path, timeout: float, max_lines: int = 64) -> tuple[int, str]:
+    """Run a command, keeping only the last ``max_lines`` lines of its output.
+
+    Compilers can log megabytes on a bad input; only the tail is useful for
+    error messages, so the rest is streamed past instead of buffered.
+    Raises subprocess.TimeoutExpired if the command runs too long.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+    )
+    timed_out = threading.Event()
+
+    def _kill() -> None:
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, _kill)
+    timer.start()
+    assert proc.stdout is not None
+    try:
+        with proc.stdout:
+            tail = deque(proc.stdout, maxlen=max_lines)
+        returncode = proc.wait()
+    finally:
+        timer.cancel()
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    return returncode, "".join(tail)
+
+
 def render_latex(path: str) -> dict[str, Any]:
     """Render a LaTeX file to PDF."""
-    full_path = BASE_DIR / path.lstrip("/")
-    full_path = full_path.resolve()
-
-    if not str(full_path).startswith(str(BASE_DIR)):
-        raise ValueError("Access denied: path outside base directory")
+    full_path = _resolve_within_base(path)
 
     if not full_path.is_file() or not full_path.suffix == ".tex":
         raise ValueError(f"Not a .tex file: {path}")
@@ -222,19 +496,17 @@ def render_latex(path: str) -> dict[str, Any]:
         stub_path.write_text(r"\ifx\pdfglyphtounicode\undefined\def\pdfglyphtounicode#1#2{}\fi" + "\n")
 
     try:
-        result = subprocess.run(
+        returncode, output = _run_with_output_tail(
             ["tectonic", "-Z", "continue-on-errors", tex_filename],
             cwd=tex_dir,
-            capture_output=True,
-            text=True,
             timeout=120,
         )
 
-        if result.returncode != 0 or not pdf_path.exists():
-            error_msg = result.stderr or result.stdout or "tectonic compilation failed"
-            return {"success": False, "error": error_msg[:500]}
+        if returncode != 0 or not pdf_path.exists():
+            error_msg = output or "tectonic compilation failed"
+            return {"success": False, "error": error_msg[-500:]}
 
-        rel_pdf_path = pdf_path.relative_to(BASE_DIR)
+        rel_pdf_path = pdf_path.relative_to(_BASE_RESOLVED)
         return {
             "success": True,
             "pdf_path": str(rel_pdf_path),
@@ -248,8 +520,8 @@ def render_latex(path: str) -> dict[str, Any]:
     except Exception as e:
         return {"success": False, "error": str(e)}
     finally:
-        if stub_created and stub_path.exists():
-            stub_path.unlink()
+        if stub_created:
+            stub_path.unlink(missing_ok=True)
 
 
 # MCP Resources
@@ -271,6 +543,12 @@ async def read_resource(uri: str) -> str:
     file_data = read_file(path)
 
     if file_data["is_text"]:
+        if file_data["truncated"]:
+            # Appended rather than prepended so line positions stay intact
+            return (
+                f"{file_data['content']}\n\n"
+                f"[Truncated: showing first {MAX_TEXT_BYTES} of {file_data['size']} bytes]"
+            )
         return file_data["content"]
     else:
         return f"Binary file: {path} ({file_data['size']} bytes, {file_data['mime_type']})"
@@ -460,312 +738,370 @@ async def list_tools() -> list[Tool]:
     ]
 
 
-@app.call_tool()
-async def call_tool(name: str, arguments: Any) -> list[TextContent]:
-    """Handle tool calls."""
-    try:
-        if name == "open_viewer":
-            start_http_server()
-            state = get_state()
-            url = state.get("server_url", f"http://localhost:{HTTP_PORT}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Web viewer is running at: {url}\n\nOpen this URL in your browser to select text from files. "
-                    f"After making a selection and clicking 'Confirm Selection', use the 'get_selection' tool to retrieve it.",
-                )
-            ]
+# Tool handlers
+async def _handle_open_viewer(arguments: Any) -> list[TextContent]:
+    """Start the web UI if needed and return its URL."""
+    start_http_server()
+    state = get_state()
+    url = state.get("server_url", f"http://localhost:{HTTP_PORT}")
+    return [
+        TextContent(
+            type="text",
+            text=f"Web viewer is running at: {url}\n\nOpen this URL in your browser to select text from files. "
+            f"After making a selection and clicking 'Confirm Selection', use the 'get_selection' tool to retrieve it.",
+        )
+    ]
 
-        elif name == "list_files":
-            path = arguments.get("path", "")
-            files = list_files(path)
-            return [
-                TextContent(
-                    type="text",
-                    text=json.dumps(files, indent=2),
-                )
-            ]
 
-        elif name == "read_file":
-            path = arguments.get("path")
-            if not path:
-                raise ValueError("path is required")
+async def _handle_list_files(arguments: Any) -> list[TextContent]:
+    """List a directory under the project root."""
+    path = arguments.get("path", "")
+    files = list_files(path)
+    return [
+        TextContent(
+            type="text",
+            text=json.dumps(files, indent=2),
+        )
+    ]
 
-            file_data = read_file(path)
-            if file_data["is_text"]:
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"File: {path}\nMIME Type: {file_data['mime_type']}\n\n{file_data['content']}",
-                    )
-                ]
-            else:
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"Binary file: {path}\nMIME Type: {file_data['mime_type']}\nSize: {file_data['size']} bytes",
-                    )
-                ]
 
-        elif name == "render_latex":
-            path = arguments.get("path")
-            if not path:
-                raise ValueError("path is required")
+async def _handle_read_file(arguments: Any) -> list[TextContent]:
+    """Return a file's content, or a summary for binary files."""
+    path = arguments.get("path")
+    if not path:
+        raise ValueError("path is required")
 
-            result = render_latex(path)
-            if result["success"]:
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"LaTeX compiled successfully!\n\nPDF: {result['pdf_path']}\nView at: {result['pdf_url']}",
-                    )
-                ]
-            else:
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"LaTeX compilation failed:\n\n{result['error']}",
-                    )
-                ]
-
-        elif name == "get_selection":
-            wait = arguments.get("wait", False)
-            timeout = arguments.get("timeout", 60)
-            # Default: auto-clear in wait mode, manual clear in immediate mode
-            clear_after_read = arguments.get("clear_after_read", wait)
-
-            if wait:
-                # Polling mode - wait for new selection
-                start_time = time.time()
-                poll_count = 0
-                logger.info(f"Polling for selection (timeout: {timeout}s)")
-
-                while time.time() - start_time < timeout:
-                    state = get_state()
-                    selection = state.get("selection")
-                    poll_count += 1
-
-                    if selection and selection.get("timestamp", 0) > start_time:
-                        elapsed = time.time() - start_time
-                        logger.info(f"Selection found after {elapsed:.2f}s ({poll_count} polls)")
-
-                        # Clear the selection after reading if requested
-                        if clear_after_read:
-                            state.pop("selection", None)
-                            save_state(state)
-                            logger.debug("Selection cleared after read")
-
-                        line_info = ""
-                        start = selection.get("start_line")
-                        end = selection.get("end_line")
-                        if isinstance(start, int) and isinstance(end, int) and start > 0 and end > 0:
-                            line_info = f"Lines: {start}-{end}\n"
-
-                        voice_query_info = ""
-                        if selection.get("voice_query"):
-                            voice_query_info = f"Voice Query: {selection['voice_query']}\n"
-
-                        return [
-                            TextContent(
-                                type="text",
-                                text=f"Selection from: {selection['file_path']}\n"
-                                f"{line_info}"
-                                f"{voice_query_info}"
-                                f"\n{selection['selected_text']}",
-                            )
-                        ]
-                    await asyncio.sleep(0.5)
-
-                logger.info(f"No selection within {timeout}s ({poll_count} polls)")
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"No selection made within {timeout} seconds.",
-                    )
-                ]
-            else:
-                # Immediate mode - return current selection
-                read_start = time.time()
+    file_data = read_file(path)
+    if file_data["is_text"]:
+        truncated_info = ""
+        if file_data["truncated"]:
+            truncated_info = f"Truncated: showing first {MAX_TEXT_BYTES} of {file_data['size']} bytes\n"
+        return [
+            TextContent(
+                type="text",
+                text=f"File: {path}\nMIME Type: {file_data['mime_type']}\n{truncated_info}\n{file_data['content']}",
+            )
+        ]
+    else:
+        return [
+            TextContent(
+                type="text",
+                text=f"Binary file: {path}\nMIME Type: {file_data['mime_type']}\nSize: {file_data['size']} bytes",
+            )
+        ]
+
+
+async def _handle_render_latex(arguments: Any) -> list[TextContent]:
+    """Compile a .tex file and report the PDF location."""
+    path = arguments.get("path")
+    if not path:
+        raise ValueError("path is required")
+
+    result = render_latex(path)
+    if result["success"]:
+        return [
+            TextContent(
+                type="text",
+                text=f"LaTeX compiled successfully!\n\nPDF: {result['pdf_path']}\nView at: {result['pdf_url']}",
+            )
+        ]
+    else:
+        return [
+            TextContent(
+                type="text",
+                text=f"LaTeX compilation failed:\n\n{result['error']}",
+            )
+        ]
+
+
+def _drop_selection(selection: dict[str, Any]) -> StateUpdate:
+    """Build an update that clears selection unless the browser replaced it since."""
+    def update(state: dict[str, Any]) -> None:
+        if state.get("selection") == selection:
+            state.pop("selection", None)
+    return update
+
+
+async def _handle_get_selection(arguments: Any) -> list[TextContent]:
+    """Return the current selection, optionally waiting for a new one."""
+    wait = arguments.get("wait", False)
+    timeout = arguments.get("timeout", 60)
+    # Default: auto-clear in wait mode, manual clear in immediate mode
+    clear_after_read = arguments.get("clear_after_read", wait)
+
+    if wait:
+        # Wait mode - block until a new selection shows up
+        start_time = time.time()  # compared against selection timestamps
+        wait_start = time.monotonic()
+        poll_count = 0
+        logger.info(f"Waiting for selection (timeout: {timeout}s)")
+
+        stop_event = asyncio.Event()
+        changes = _state_file_changes(stop_event)
+        try:
+            while True:
                 state = get_state()
                 selection = state.get("selection")
-                read_time = (time.time() - read_start) * 1000  # ms
+                poll_count += 1
+
+                if selection and selection.get("timestamp", 0) > start_time:
+                    elapsed = time.monotonic() - wait_start
+                    logger.info(f"Selection found after {elapsed:.2f}s ({poll_count} polls)")
+
+                    # Clear the selection after reading if requested
+                    if clear_after_read:
+                        schedule_state_update(_drop_selection(selection))
+                        logger.debug("Selection cleared after read")
+
+                    line_info = ""
+                    start = selection.get("start_line")
+                    end = selection.get("end_line")
+                    if isinstance(start, int) and isinstance(end, int) and start > 0 and end > 0:
+                        line_info = f"Lines: {start}-{end}\n"
+
+                    voice_query_info = ""
+                    if selection.get("voice_query"):
+                        voice_query_info = f"Voice Query: {selection['voice_query']}\n"
 
-                if not selection:
-                    logger.debug(f"No selection available (read time: {read_time:.2f}ms)")
                     return [
                         TextContent(
                             type="text",
-                            text="No selection available. Use 'open_viewer' to open the UI and make a selection, "
-                            "or use wait=true to wait for a selection.",
+                            text=f"Selection from: {selection['file_path']}\n"
+                            f"{line_info}"
+                            f"{voice_query_info}"
+                            f"\n{selection['selected_text']}",
                         )
                     ]
 
-                logger.info(f"Selection retrieved in {read_time:.2f}ms")
-
-                # Clear the selection after reading if requested
-                if clear_after_read:
-                    state.pop("selection", None)
-                    save_state(state)
-                    logger.debug("Selection cleared after read")
-
-                line_info = ""
-                start = selection.get("start_line")
-                end = selection.get("end_line")
-                if isinstance(start, int) and isinstance(end, int) and start > 0 and end > 0:
-                    line_info = f"Lines: {start}-{end}\n"
-
-                voice_query_info = ""
-                if selection.get("voice_query"):
-                    voice_query_info = f"Voice Query: {selection['voice_query']}\n"
-
-                return [
-                    TextContent(
-                        type="text",
-                        text=f"Selection from: {selection['file_path']}\n"
-                        f"{line_info}"
-                        f"{voice_query_info}"
-                        f"\n{selection['selected_text']}",
-                    )
-                ]
-
-        elif name == "clear_selection":
-            state = get_state()
-            state.pop("selection", None)
-            save_state(state)
+                remaining = timeout - (time.monotonic() - wait_start)
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(changes.__anext__(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                except StopAsyncIteration:
+                    break
+        finally:
+            stop_event.set()
+            await changes.aclose()
+
+        logger.info(f"No selection within {timeout}s ({poll_count} polls)")
+        return [
+            TextContent(
+                type="text",
+                text=f"No selection made within {timeout} seconds.",
+            )
+        ]
+    else:
+        # Immediate mode - return current selection
+        read_start = time.perf_counter()
+        state = get_state()
+        selection = state.get("selection")
+        read_time = (time.perf_counter() - read_start) * 1000  # ms
+
+        if not selection:
+            logger.debug(f"No selection available (read time: {read_time:.2f}ms)")
             return [
                 TextContent(
                     type="text",
-                    text="Selection cleared.",
+                    text="No selection available. Use 'open_viewer' to open the UI and make a selection, "
+                    "or use wait=true to wait for a selection.",
                 )
             ]
 
-        elif name == "navigate_to_line":
-            path = arguments.get("path")
-            line = arguments.get("line")
-            if not path or line is None:
-                raise ValueError("path and line are required")
-
-            state = get_state()
-            state["navigation"] = {
-                "command": "goto_line",
-                "file_path": path,
-                "target": line,
-                "timestamp": time.time(),
-                "executed": False,
-            }
-            save_state(state)
-            logger.info(f"Navigation command issued: goto line {line} in {path}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Navigation command sent: Go to line {line} in {path}\n\n"
-                    f"The web viewer will automatically navigate to this location if it's open.",
-                )
-            ]
+        logger.info(f"Selection retrieved in {read_time:.2f}ms")
 
-        elif name == "navigate_to_text":
-            path = arguments.get("path")
-            text = arguments.get("text")
-            if not path or not text:
-                raise ValueError("path and text are required")
-
-            state = get_state()
-            state["navigation"] = {
-                "command": "search_text",
-                "file_path": path,
-                "target": text,
-                "timestamp": time.time(),
-                "executed": False,
-            }
-            save_state(state)
-            logger.info(f"Navigation command issued: search for '{text}' in {path}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Navigation command sent: Search for '{text}' in {path}\n\n"
-                    f"The web viewer will automatically navigate to the first occurrence if it's open.",
-                )
-            ]
+        # Clear the selection after reading if requested
+        if clear_after_read:
+            schedule_state_update(_drop_selection(selection))
+            logger.debug("Selection cleared after read")
 
-        elif name == "navigate_to_function":
-            path = arguments.get("path")
-            name_arg = arguments.get("name")
-            if not path or not name_arg:
-                raise ValueError("path and name are required")
-
-            state = get_state()
-            state["navigation"] = {
-                "command": "find_function",
-                "file_path": path,
-                "target": name_arg,
-                "timestamp": time.time(),
-                "executed": False,
-            }
-            save_state(state)
-            logger.info(f"Navigation command issued: find function/class '{name_arg}' in {path}")
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Navigation command sent: Find function/class '{name_arg}' in {path}\n\n"
-                    f"The web viewer will automatically navigate to the definition if it's open.",
-                )
-            ]
+        line_info = ""
+        start = selection.get("start_line")
+        end = selection.get("end_line")
+        if isinstance(start, int) and isinstance(end, int) and start > 0 and end > 0:
+            line_info = f"Lines: {start}-{end}\n"
 
-        elif name == "speak_text":
-            text = arguments.get("text")
-            if not text:
-                raise ValueError("text is required")
-
-            state = get_state()
-            state["voice_response"] = {
-                "text": text,
-                "timestamp": time.time(),
-                "spoken": False,
-            }
-            save_state(state)
-            preview = text[:80] + ("…" if len(text) > 80 else "")
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Speaking in browser: \"{preview}\"",
-                )
-            ]
+        voice_query_info = ""
+        if selection.get("voice_query"):
+            voice_query_info = f"Voice Query: {selection['voice_query']}\n"
 
-        elif name == "pin_annotation":
-            text = arguments.get("text")
-            file_path = arguments.get("file_path")
-            if not text or not file_path:
-                raise ValueError("text and file_path are required")
-
-            start_line = arguments.get("start_line", 0)
-            end_line = arguments.get("end_line", start_line)
-            label = arguments.get("label", "Claude")
-
-            state = get_state()
-            annotations = state.get("annotations", [])
-            annotation_id = f"{int(time.time() * 1000)}-{len(annotations)}"
-            annotations.append({
-                "id": annotation_id,
-                "file_path": file_path,
-                "start_line": start_line,
-                "end_line": end_line,
-                "text": text,
-                "label": label,
-                "timestamp": time.time(),
-            })
-            state["annotations"] = annotations
-            save_state(state)
-
-            line_info = f" lines {start_line}–{end_line}" if start_line else ""
-            return [
-                TextContent(
-                    type="text",
-                    text=f"Annotation pinned to {file_path}{line_info}. It will appear in the viewer.",
-                )
-            ]
+        return [
+            TextContent(
+                type="text",
+                text=f"Selection from: {selection['file_path']}\n"
+                f"{line_info}"
+                f"{voice_query_info}"
+                f"\n{selection['selected_text']}",
+            )
+        ]
 
-        else:
+
+async def _handle_clear_selection(arguments: Any) -> list[TextContent]:
+    """Drop the current selection from the state file."""
+    schedule_state_update(lambda state: state.pop("selection", None))
+    return [
+        TextContent(
+            type="text",
+            text="Selection cleared.",
+        )
+    ]
+
+
+async def _handle_navigate_to_line(arguments: Any) -> list[TextContent]:
+    """Ask the viewer to jump to a line."""
+    path = arguments.get("path")
+    line = arguments.get("line")
+    if not path or line is None:
+        raise ValueError("path and line are required")
+
+    navigation = {
+        "command": "goto_line",
+        "file_path": path,
+        "target": line,
+        "timestamp": time.time(),
+        "executed": False,
+    }
+    schedule_state_update(lambda state: state.update(navigation=navigation))
+    logger.info(f"Navigation command issued: goto line {line} in {path}")
+    return [
+        TextContent(
+            type="text",
+            text=f"Navigation command sent: Go to line {line} in {path}\n\n"
+            f"The web viewer will automatically navigate to this location if it's open.",
+        )
+    ]
+
+
+async def _handle_navigate_to_text(arguments: Any) -> list[TextContent]:
+    """Ask the viewer to jump to the first match of some text."""
+    path = arguments.get("path")
+    text = arguments.get("text")
+    if not path or not text:
+        raise ValueError("path and text are required")
+
+    navigation = {
+        "command": "search_text",
+        "file_path": path,
+        "target": text,
+        "timestamp": time.time(),
+        "executed": False,
+    }
+    schedule_state_update(lambda state: state.update(navigation=navigation))
+    logger.info(f"Navigation command issued: search for '{text}' in {path}")
+    return [
+        TextContent(
+            type="text",
+            text=f"Navigation command sent: Search for '{text}' in {path}\n\n"
+            f"The web viewer will automatically navigate to the first occurrence if it's open.",
+        )
+    ]
+
+
+async def _handle_navigate_to_function(arguments: Any) -> list[TextContent]:
+    """Ask the viewer to jump to a function or class definition."""
+    path = arguments.get("path")
+    name_arg = arguments.get("name")
+    if not path or not name_arg:
+        raise ValueError("path and name are required")
+
+    navigation = {
+        "command": "find_function",
+        "file_path": path,
+        "target": name_arg,
+        "timestamp": time.time(),
+        "executed": False,
+    }
+    schedule_state_update(lambda state: state.update(navigation=navigation))
+    logger.info(f"Navigation command issued: find function/class '{name_arg}' in {path}")
+    return [
+        TextContent(
+            type="text",
+            text=f"Navigation command sent: Find function/class '{name_arg}' in {path}\n\n"
+            f"The web viewer will automatically navigate to the definition if it's open.",
+        )
+    ]
+
+
+async def _handle_speak_text(arguments: Any) -> list[TextContent]:
+    """Queue text for the browser to speak aloud."""
+    text = arguments.get("text")
+    if not text:
+        raise ValueError("text is required")
+
+    voice_response = {
+        "text": text,
+        "timestamp": time.time(),
+        "spoken": False,
+    }
+    schedule_state_update(lambda state: state.update(voice_response=voice_response))
+    preview = text[:80] + ("…" if len(text) > 80 else "")
+    return [
+        TextContent(
+            type="text",
+            text=f"Speaking in browser: \"{preview}\"",
+        )
+    ]
+
+
+async def _handle_pin_annotation(arguments: Any) -> list[TextContent]:
+    """Attach an annotation to a line range in the viewer."""
+    text = arguments.get("text")
+    file_path = arguments.get("file_path")
+    if not text or not file_path:
+        raise ValueError("text and file_path are required")
+
+    start_line = arguments.get("start_line", 0)
+    end_line = arguments.get("end_line", start_line)
+    label = arguments.get("label", "Claude")
+
+    annotation_id = f"{int(time.time() * 1000)}-{len(get_state().get('annotations', []))}"
+    annotation = {
+        "id": annotation_id,
+        "file_path": file_path,
+        "start_line": start_line,
+        "end_line": end_line,
+        "text": text,
+        "label": label,
+        "timestamp": time.time(),
+    }
+    schedule_state_update(
+        lambda state: state.update(annotations=[*state.get("annotations", []), annotation])
+    )
+
+    line_info = f" lines {start_line}–{end_line}" if start_line else ""
+    return [
+        TextContent(
+            type="text",
+            text=f"Annotation pinned to {file_path}{line_info}. It will appear in the viewer.",
+        )
+    ]
+
+
+_TOOL_HANDLERS: dict[str, Callable[[Any], Awaitable[list[TextContent]]]] = {
+    "open_viewer": _handle_open_viewer,
+    "list_files": _handle_list_files,
+    "read_file": _handle_read_file,
+    "render_latex": _handle_render_latex,
+    "get_selection": _handle_get_selection,
+    "clear_selection": _handle_clear_selection,
+    "navigate_to_line": _handle_navigate_to_line,
+    "navigate_to_text": _handle_navigate_to_text,
+    "navigate_to_function": _handle_navigate_to_function,
+    "speak_text": _handle_speak_text,
+    "pin_annotation": _handle_pin_annotation,
+}
+
+
+@app.call_tool()
+async def call_tool(name: str, arguments: Any) -> list[TextContent]:
+    """Handle tool calls."""
+    try:
+        handler = _TOOL_HANDLERS.get(name)
+        if handler is None:
             raise ValueError(f"Unknown tool: {name}")
+        return await handler(arguments)
 
     except Exception as e:
         logger.error(f"Tool error: {e}", exc_info=True)
@@ -786,33 +1122,33 @@ async def list_prompts() -> list[Prompt]:
             name="analyze-selection",
             description="Analyze a code or document selection from the viewer",
             arguments=[
-                {
-                    "name": "question",
-                    "description": "What you want to know about the selection",
-                    "required": False,
-                }
+                PromptArgument(
+                    name="question",
+                    description="What you want to know about the selection",
+                    required=False,
+                )
             ],
         ),
         Prompt(
             name="refactor-selection",
             description="Refactor selected code with specific instructions",
             arguments=[
-                {
-                    "name": "instructions",
-                    "description": "How to refactor the code",
-                    "required": True,
-                }
+                PromptArgument(
+                    name="instructions",
+                    description="How to refactor the code",
+                    required=True,
+                )
             ],
         ),
         Prompt(
             name="explain-latex",
             description="Explain a LaTeX document section",
             arguments=[
-                {
-                    "name": "focus",
-                    "description": "What aspect to focus on (structure, content, formatting, etc.)",
-                    "required": False,
-                }
+                PromptArgument(
+                    name="focus",
+                    description="What aspect to focus on (structure, content, formatting, etc.)",
+                    required=False,
+                )
             ],
         ),
     ]
@@ -935,7 +1271,7 @@ async def get_prompt(name: str, arguments: dict[str, str] | None) -> GetPromptRe
         raise ValueError(f"Unknown prompt: {name}")
 
 
-async def main():
+async def main() -> None:
     """Main entry point."""
     logger.info("Starting ContextViewer MCP Server")
     logger.info(f"Base directory: {BASE_DIR}")
@@ -950,6 +1286,7 @@ async def main():
 
     finally:
         # Cleanup
+        flush_state()
         stop_http_server()
         logger.info("ContextViewer MCP Server stopped")
 
@@ -1,15 +1,124 @@
 #!/usr/bin/env python3
+import functools
+import gzip
+import hashlib
 import json
 import mimetypes
 import os
+import queue
+import re
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from typing import TextIO
 from urllib.parse import quote, unquote, urlparse, parse_qs
 
+import state_file
+from file_limits import MAX_TEXT_BYTES, SNIFF_BYTES
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON encoding for API responses
+    orjson = None  # type: ignore[assignment]
+
+STATIC_CACHE_MAX_BYTES = 1024 * 1024
+CONTENT_CACHE_MAX_BYTES = 1024 * 1024
+CACHE_MAX_ENTRIES = 512
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # per cache, bodies plus gzipped copies
+GZIP_MIN_BYTES = 1024
+CACHE_TTL = float(os.environ.get("CONTEXTVIEWER_CACHE_TTL", "10"))
+
+
+def _dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def _loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _load_state() -> dict:
+    try:
+        return state_file.loads(state_file.STATE_FILE.read_bytes())
+    except FileNotFoundError:
+        return {}
+
+
+_MIME_CACHE: dict[str, str | None] = {}
+
+
+def _guess_mime(path: str) -> str | None:
+    """mimetypes.guess_type, memoized by extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in _MIME_CACHE:
+        return _MIME_CACHE[ext]
+    mime_type, encoding = mimetypes.guess_type(path)
+    # Compressed types (.gz, .tgz, ...) depend on more than the last suffix
+    if encoding is None:
+        _MIME_CACHE[ext] = mime_type
+    return mime_type
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_url_path(base_dir: str, url_path: str) -> tuple[str, str]:
+    """Decode a URL path and join it onto base_dir (purely lexical, so safe to memoize)."""
+    path = unquote(url_path.split("?", 1)[0]).lstrip("/")
+    return path, os.path.normpath(os.path.join(base_dir, path))
+
+
+def _is_within(full_path: str, root_prefix: str) -> bool:
+    """True if the resolved full_path is root_prefix's directory or inside it.
+
+    root_prefix is a realpath ending in a separator, so "/srv/a" never
+    matches a sibling like "/srv/ab".
+    """
+    return full_path.startswith(root_prefix) or full_path == root_prefix[:-1]
+
+
+def _etag(st: os.stat_result) -> str:
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _parse_range(header: str | None, size: int) -> tuple[int, int] | None | bool:
+    """Parse a single "bytes=" Range header into an inclusive (start, end).
+
+    Returns None when the whole file should be sent (no header, or a form we
+    don't handle such as multiple ranges) and False when it's unsatisfiable.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0 or size == 0:
+                return False
+            return max(0, size - suffix), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if last and end < start:  # syntactically invalid: ignore it, send the whole file
+        return None
+    if start >= size:
+        return False
+    return start, min(end, size - 1)
+
+
+_STATIC_DIR_PREFIX = os.path.join(os.path.realpath(os.path.join(os.path.dirname(__file__), "static")), "")
+
 
 def _find_tectonic() -> str | None:
     """Find the tectonic binary, checking PATH and common Homebrew locations."""
@@ -21,108 +130,404 @@ def _find_tectonic() -> str | None:
     return None
 
 
-class FileServerHandler(SimpleHTTPRequestHandler):
-    base_dir = os.getcwd()
+def _run_tectonic(
+    tectonic: str, tex_dir: str, tex_filename: str, pdf_path: str
+) -> tuple[subprocess.CompletedProcess, tuple[str, ...] | None]:
+    """Compile tex_filename inside tex_dir with tectonic and move the PDF to pdf_path.
+
+    Also returns the files from the user's tree the compile read, taken from
+    tectonic's --makefile-rules output, or None if that wasn't written.
+    """
+    # Build into a scratch dir so nothing but the finished PDF lands in the
+    # user's tree and concurrent renders of one file can't clobber each other.
+    with tempfile.TemporaryDirectory(prefix="ctxview-tex-") as tmp:
+        rules_path = os.path.join(tmp, "deps.mk")
+        cmd = [tectonic, "-Z", "continue-on-errors", "--outdir", tmp, "--makefile-rules", rules_path]
+
+        # Tectonic uses XeTeX which lacks \pdfglyphtounicode. Put a stub that
+        # defines it as a no-op on the search path so tectonic doesn't choke on it.
+        if not os.path.exists(os.path.join(tex_dir, "glyphtounicode.tex")):
+            with open(os.path.join(tmp, "glyphtounicode.tex"), "w") as f:
+                f.write(r"\ifx\pdfglyphtounicode\undefined\def\pdfglyphtounicode#1#2{}\fi" + "\n")
+            cmd += ["-Z", f"search-path={tmp}"]
+
+        result = subprocess.run(
+            cmd + [tex_filename],
+            cwd=tex_dir,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+
+        deps: tuple[str, ...] | None = None
+        try:
+            with open(rules_path, encoding="utf-8") as f:
+                inputs = _makefile_rule_inputs(f.read(), tex_dir)
+        except FileNotFoundError:
+            pass
+        else:
+            # Keep real files in the user's tree; the stub and build outputs
+            # live in tmp and the PDF itself is not an input.
+            tmp_prefix = os.path.join(os.path.realpath(tmp), "")
+            real_pdf = os.path.realpath(pdf_path)
+            deps = tuple(
+                dep for dep in inputs
+                if not dep.startswith(tmp_prefix) and dep != real_pdf and os.path.isfile(dep)
+            )
 
-    def do_GET(self):
-        if self.path == "/":
-            self.send_response(200)
-            self.send_header("Content-type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(self.get_html().encode("utf-8"))
-            return
+        built_pdf = os.path.join(tmp, os.path.basename(pdf_path))
+        if os.path.exists(built_pdf):
+            shutil.move(built_pdf, pdf_path)
+        return result, deps
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _makefile_rule_inputs(rules: str, cwd: str) -> list[str]:
+    """Absolute paths of the prerequisites in Makefile-format dependency rules."""
+    inputs = []
+    for line in rules.replace("\\\n", " ").splitlines():
+        _, sep, names = line.partition(": ")
+        if not sep:
+            continue
+        for name in re.split(r"(?<!\\)\s+", names.strip()):
+            if name:
+                inputs.append(os.path.realpath(os.path.join(cwd, name.replace("\\ ", " "))))
+    return inputs
+
+
+def _newest_mtime(paths: tuple[str, ...]) -> int | None:
+    """Newest mtime_ns among paths, or None if any of them has gone away."""
+    newest = 0
+    for path in paths:
+        try:
+            newest = max(newest, os.stat(path).st_mtime_ns)
+        except OSError:
+            return None
+    return newest
 
-        if self.path.startswith("/static/"):
-            self.handle_static_file()
-            return
 
-        if self.path.startswith("/api/files"):
-            self.handle_files_api()
-            return
+# full .tex path -> (mtime_ns, size, sha256, pdf_path, deps) of the last
+# successful compile; deps are the other files tectonic reported reading
+_tex_cache: dict[str, tuple[int, int, str, str, tuple[str, ...]]] = {}
+_tex_cache_lock = threading.Lock()
 
-        if self.path.startswith("/api/file-content"):
-            self.handle_file_content_api()
-            return
+def _load_index_html() -> bytes:
+    index_path = os.path.join(os.path.dirname(__file__), "static", "index.html")
+    try:
+        with open(index_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return b"<html><body><h1>Error: index.html not found in static directory</h1></body></html>"
 
-        if self.path.startswith("/api/render-tex"):
-            self.handle_render_tex_api()
-            return
 
-        if self.path == "/api/navigation-state":
-            self.handle_navigation_state_api()
-            return
+# The page shell never changes while the server runs: read and compress it once.
+_INDEX_HTML = _load_index_html()
+_INDEX_GZ = gzip.compress(_INDEX_HTML, 9)
+_INDEX_ETAG = '"%s"' % hashlib.sha256(_INDEX_HTML).hexdigest()[:16]
+_INDEX_GZ_ETAG = _INDEX_ETAG[:-1] + '-gz"'
 
-        if self.path.startswith("/api/file-mtime"):
-            self.handle_file_mtime_api()
-            return
+# Console output from request handlers is written by one background thread,
+# started in __main__, so a slow terminal or pipe never holds up a response.
+_print_queue: queue.Queue[tuple[str, TextIO] | None] = queue.Queue()
 
-        if self.path.startswith("/api/annotations"):
-            self.handle_annotations_api()
-            return
 
-        super().do_GET()
+def _print_worker() -> None:
+    # None, queued at shutdown, stops the worker once earlier messages are out
+    while (item := _print_queue.get()) is not None:
+        message, stream = item
+        print(message, file=stream, flush=True)
 
-    def do_POST(self):
-        if self.path == "/api/confirm-selection":
-            self.handle_confirm_selection()
+
+def _print_async(message: str, stream: TextIO | None = None) -> None:
+    _print_queue.put((message, stream or sys.stdout))
+
+# Serializes read-modify-write cycles on STATE_FILE across handler threads;
+# state_file.lock() extends that to the MCP server process
+_state_lock = threading.Lock()
+
+# static path -> (mtime_ns, size, body, mime_type); the bundled assets are small
+_static_cache: dict[str, tuple[int, int, bytes, str]] = {}
+_static_cache_lock = threading.Lock()
+
+class _ResponseCache:
+    """LRU of encoded JSON responses capped by entry count and total bytes."""
+
+    def __init__(self) -> None:
+        self.entries: OrderedDict = OrderedDict()
+        self.nbytes = 0
+
+
+# Encoded JSON responses, revalidated by stat and expired after CACHE_TTL so
+# changes a stat can't see (a file resized in place) still show up.
+# directory -> (dir mtime_ns, stored_at, [listing, gzipped listing, cache]);
+# (file, request path) -> ((mtime_ns, size), stored_at, [response, gzipped, cache]).
+# The gzipped slot is filled the first time a client accepts gzip; the cache
+# slot points back at the owning cache while the entry is counted in it.
+_listing_cache = _ResponseCache()
+_content_cache = _ResponseCache()
+_response_cache_lock = threading.Lock()
+
+
+def _entry_bytes(entry: list) -> int:
+    return len(entry[0]) + (len(entry[1]) if entry[1] is not None else 0)
+
+
+def _cache_drop(cache: _ResponseCache, key) -> None:
+    # Caller holds _response_cache_lock
+    entry = cache.entries.pop(key)[2]
+    cache.nbytes -= _entry_bytes(entry)
+    entry[2] = None
+
+
+def _cache_trim(cache: _ResponseCache) -> None:
+    # Caller holds _response_cache_lock
+    while cache.entries and (
+        len(cache.entries) > CACHE_MAX_ENTRIES or cache.nbytes > RESPONSE_CACHE_MAX_BYTES
+    ):
+        _cache_drop(cache, next(iter(cache.entries)))
+
+
+def _cache_get(cache: _ResponseCache, key, stamp) -> list | None:
+    with _response_cache_lock:
+        item = cache.entries.get(key)
+        if item is None:
+            return None
+        if item[0] != stamp or time.monotonic() - item[1] >= CACHE_TTL:
+            _cache_drop(cache, key)
+            return None
+        cache.entries.move_to_end(key)
+        return item[2]
+
+
+def _cache_put(cache: _ResponseCache, key, stamp, body: bytes) -> list:
+    entry = [body, None, cache]
+    with _response_cache_lock:
+        if key in cache.entries:
+            _cache_drop(cache, key)
+        cache.entries[key] = (stamp, time.monotonic(), entry)
+        cache.nbytes += len(body)
+        _cache_trim(cache)
+    return entry
+
+
+def _entry_set_gzip(entry: list, compressed: bytes) -> None:
+    """Store entry's gzipped body, counting it against its cache if still held."""
+    with _response_cache_lock:
+        if entry[1] is not None:
             return
+        entry[1] = compressed
+        cache = entry[2]
+        if cache is not None:
+            cache.nbytes += len(compressed)
+            _cache_trim(cache)
 
-        if self.path == "/api/navigation-executed":
-            self.handle_navigation_executed()
+
+_RENDER_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="tectonic")
+
+
+class FileServerHandler(SimpleHTTPRequestHandler):
+    # Both resolved once; see _is_within. __main__ resets them for --serve-dir.
+    base_dir = os.path.realpath(os.getcwd())
+    _base_dir_prefix = os.path.join(base_dir, "")
+    # Keep-alive lets the browser reuse one connection for its burst of
+    # requests; every response must therefore carry a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections give their handler slot back after this long
+    timeout = 30
+    # Buffer responses so the status line, headers and a small body leave in
+    # one send when handle_one_request flushes, instead of one per write.
+    wbufsize = 64 * 1024
+
+    # Exact paths are a dict hit; prefixed routes are checked in order.
+    _GET_EXACT = {
+        "/": "handle_index",
+        "/api/navigation-state": "handle_navigation_state_api",
+    }
+    _GET_ROUTES = (
+        ("/static/", "handle_static_file"),
+        ("/api/files", "handle_files_api"),
+        ("/api/file-content", "handle_file_content_api"),
+        ("/api/render-tex", "handle_render_tex_api"),
+        ("/api/file-mtime", "handle_file_mtime_api"),
+        ("/api/annotations", "handle_annotations_api"),
+    )
+    _POST_EXACT = {
+        "/api/confirm-selection": "handle_confirm_selection",
+        "/api/navigation-executed": "handle_navigation_executed",
+        "/api/voice-spoken": "handle_voice_spoken",
+        "/api/delete-annotation": "handle_delete_annotation",
+    }
+
+    def do_GET(self):
+        name = self._GET_EXACT.get(self.path)
+        if name is None:
+            for prefix, handler in self._GET_ROUTES:
+                if self.path.startswith(prefix):
+                    name = handler
+                    break
+        if name is not None:
+            getattr(self, name)()
             return
 
-        if self.path == "/api/voice-spoken":
-            self.handle_voice_spoken()
+        if not self.handle_base_file():
+            super().do_GET()
+
+    def log_message(self, format, *args):
+        """Queue the access-log line for the print thread instead of writing stderr inline."""
+        message = (format % args).translate(self._control_char_table)
+        _print_async(
+            f"{self.address_string()} - - [{self.log_date_time_string()}] {message}", sys.stderr
+        )
+
+    def do_POST(self):
+        name = self._POST_EXACT.get(self.path)
+        if name is not None:
+            getattr(self, name)()
             return
 
-        if self.path == "/api/delete-annotation":
-            self.handle_delete_annotation()
+        # Drain the unread body so it can't corrupt the next keep-alive request
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        self.send_empty_response(404)
+
+    def resolve_request_path(self, route):
+        """Split the URL after route into (decoded relative path, realpath under base_dir)."""
+        path, joined = _decode_url_path(self.base_dir, self.path[len(route):])
+        # realpath is not cached: a symlink created or retargeted later must
+        # still be caught by the _is_within check.
+        return path, os.path.realpath(joined)
+
+    def handle_index(self):
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        etag = _INDEX_GZ_ETAG if gzipped else _INDEX_ETAG
+        if self.headers.get("If-None-Match") == etag:
+            self.send_not_modified(etag)
             return
 
-        self.send_response(404)
-        self.end_headers()
+        # no-cache still lets the browser keep the page, but it revalidates
+        # each load so a restarted server with a new index is picked up.
+        headers = [("Vary", "Accept-Encoding"), ("ETag", etag), ("Cache-Control", "no-cache")]
+        if gzipped:
+            headers.append(("Content-Encoding", "gzip"))
+            self._send_bytes(_INDEX_GZ, "text/html; charset=utf-8", headers)
+        else:
+            self._send_bytes(_INDEX_HTML, "text/html; charset=utf-8", headers)
 
     def handle_static_file(self):
         try:
             # Remove /static/ prefix and get the file path
             file_path = self.path.replace("/static/", "", 1)
-            static_dir = os.path.join(os.path.dirname(__file__), "static")
-            full_path = os.path.join(static_dir, file_path)
-            full_path = os.path.normpath(full_path)
+            full_path = os.path.realpath(os.path.join(_STATIC_DIR_PREFIX, file_path))
 
             # Security check: ensure we're serving from static dir
-            if not full_path.startswith(static_dir):
+            if not _is_within(full_path, _STATIC_DIR_PREFIX):
                 self.send_error(403)
                 return
 
-            if not os.path.isfile(full_path):
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
                 self.send_error(404)
                 return
 
-            # Determine content type
-            mime_type, _ = mimetypes.guess_type(full_path)
-            if mime_type is None:
-                mime_type = "application/octet-stream"
+            etag = _etag(st)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_not_modified(etag)
+                return
 
-            # Read and serve the file
-            with open(full_path, "rb") as f:
-                content = f.read()
+            with _static_cache_lock:
+                cached = _static_cache.get(full_path)
+            if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                content, mime_type = cached[2], cached[3]
+            else:
+                mime_type = _guess_mime(full_path) or "application/octet-stream"
+                content = None
+                if st.st_size <= STATIC_CACHE_MAX_BYTES:
+                    with open(full_path, "rb") as f:
+                        content = f.read()
+                    with _static_cache_lock:
+                        _static_cache[full_path] = (st.st_mtime_ns, st.st_size, content, mime_type)
+
+            if content is not None and "Range" not in self.headers:
+                self._send_bytes(content, mime_type, [("ETag", etag), ("Accept-Ranges", "bytes")])
+                return
 
-            self.send_response(200)
-            self.send_header("Content-type", mime_type)
-            self.send_header("Content-Length", len(content))
-            self.end_headers()
-            self.wfile.write(content)
+            self.send_file(full_path, mime_type, etag)
         except Exception:
             self.send_error(500)
 
+    def handle_base_file(self):
+        """Serve a regular file under base_dir (e.g. a rendered PDF).
+
+        Returns False when the path isn't a regular file, so the caller can
+        fall back to SimpleHTTPRequestHandler for directory listings.
+        """
+        path = unquote(urlparse(self.path).path).lstrip("/")
+        full_path = os.path.realpath(os.path.join(self.base_dir, path))
+        if not _is_within(full_path, self._base_dir_prefix):
+            self.send_error(403)
+            return True
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+
+        try:
+            etag = _etag(st)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_not_modified(etag)
+                return True
+            self.send_file(full_path, _guess_mime(full_path) or "application/octet-stream", etag)
+        except Exception:
+            self.send_error(500)
+        return True
+
+    def send_file(self, full_path, mime_type, etag):
+        """Stream a file with sendfile, honoring a single-range Range header."""
+        # socket.sendfile falls back to read/send where os.sendfile is missing.
+        with open(full_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = _parse_range(self.headers.get("Range"), size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, length = 0, size
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                length = end - start + 1
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-type", mime_type)
+            self.send_header("Content-Length", length)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if length:
+                # sendfile bypasses wfile, so push the buffered headers first
+                self.wfile.flush()
+                self.connection.sendfile(f, start, length)
+
     def handle_files_api(self):
         try:
-            path = unquote(self.path.replace("/api/files", "", 1)) or "/"
-            full_path = os.path.join(self.base_dir, path.lstrip("/"))
-            full_path = os.path.normpath(full_path)
+            _, full_path = self.resolve_request_path("/api/files")
 
-            if not full_path.startswith(self.base_dir):
+            if not _is_within(full_path, self._base_dir_prefix):
                 self.send_error(403)
                 return
 
@@ -134,75 +539,97 @@ class FileServerHandler(SimpleHTTPRequestHandler):
                 self.send_error(400)
                 return
 
-            items = []
-            for item in sorted(os.listdir(full_path)):
-                if item.startswith("."):
-                    continue
-                item_path = os.path.join(full_path, item)
-                rel_path = os.path.relpath(item_path, self.base_dir)
-                is_dir = os.path.isdir(item_path)
-                items.append(
-                    {
-                        "name": item,
-                        "path": quote(rel_path),
-                        "is_dir": is_dir,
-                        "size": os.path.getsize(item_path) if not is_dir else 0,
-                    }
-                )
+            # A directory's mtime moves whenever an entry is added, removed or
+            # renamed, which is exactly when the listing changes shape.
+            dir_mtime = os.stat(full_path).st_mtime_ns
+            cached = _cache_get(_listing_cache, full_path, dir_mtime)
+            if cached is not None:
+                self.send_json_entry(cached)
+                return
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(items).encode("utf-8"))
+            # scandir hands back type info from the directory read itself, so
+            # only regular files cost a stat (for their size).
+            rel_dir = os.path.relpath(full_path, self.base_dir)
+            prefix = "" if rel_dir == "." else rel_dir + os.sep
+            items = []
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    if entry.name.startswith("."):
+                        continue
+                    is_dir = entry.is_dir()
+                    items.append(
+                        {
+                            "name": entry.name,
+                            "path": quote(prefix + entry.name),
+                            "is_dir": is_dir,
+                            "size": entry.stat().st_size if not is_dir else 0,
+                        }
+                    )
+            items.sort(key=lambda i: i["name"])
+
+            body = _dumps(items)
+            self.send_json_entry(_cache_put(_listing_cache, full_path, dir_mtime, body))
         except Exception:
             self.send_error(500)
 
     def handle_file_content_api(self):
         try:
-            path = unquote(self.path.replace("/api/file-content", "", 1)).lstrip("/")
-            full_path = os.path.join(self.base_dir, path)
-            full_path = os.path.normpath(full_path)
+            path, full_path = self.resolve_request_path("/api/file-content")
 
-            if not full_path.startswith(self.base_dir):
+            if not _is_within(full_path, self._base_dir_prefix):
                 self.send_error(403)
                 return
 
-            if not os.path.isfile(full_path):
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
                 self.send_error(404)
                 return
 
-            mime_type, _ = mimetypes.guess_type(full_path)
+            cache_key = (full_path, path)
+            file_stamp = (st.st_mtime_ns, st.st_size)
+            cached = _cache_get(_content_cache, cache_key, file_stamp)
+            if cached is not None:
+                self.send_json_entry(cached)
+                return
+
+            mime_type = _guess_mime(full_path)
             is_text = False
+            truncated = False
             content = None
+            # Decide text vs binary from a bounded head so large binaries are
+            # never read in full; text bodies are capped at MAX_TEXT_BYTES.
             with open(full_path, "rb") as f:
-                raw = f.read()
-            if b"\x00" not in raw:
-                content = raw.decode("utf-8", errors="replace")
-                is_text = True
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(
-                json.dumps(
-                    {
-                        "content": content,
-                        "mime_type": mime_type,
-                        "is_text": is_text,
-                        "file_url": f"/{quote(path)}",
-                    }
-                ).encode("utf-8")
+                head = f.read(SNIFF_BYTES)
+                if b"\x00" not in head:
+                    raw = head + f.read(max(0, MAX_TEXT_BYTES - len(head)))
+                    truncated = bool(f.read(1))
+                    content = raw.decode("utf-8", errors="replace")
+                    is_text = True
+
+            body = _dumps(
+                {
+                    "content": content,
+                    "mime_type": mime_type,
+                    "is_text": is_text,
+                    "truncated": truncated,
+                    "file_url": f"/{quote(path)}",
+                }
             )
+            if len(body) <= CONTENT_CACHE_MAX_BYTES:
+                self.send_json_entry(_cache_put(_content_cache, cache_key, file_stamp, body))
+            else:
+                self.send_json_entry([body, None, None])
         except Exception:
             self.send_error(500)
 
     def handle_render_tex_api(self):
         try:
-            path = unquote(self.path.replace("/api/render-tex", "", 1)).lstrip("/")
-            full_path = os.path.join(self.base_dir, path)
-            full_path = os.path.normpath(full_path)
+            _, full_path = self.resolve_request_path("/api/render-tex")
 
-            if not full_path.startswith(self.base_dir):
+            if not _is_within(full_path, self._base_dir_prefix):
                 self.send_json_response({"success": False, "error": "Access denied"})
                 return
 
@@ -220,31 +647,49 @@ class FileServerHandler(SimpleHTTPRequestHandler):
             pdf_filename = tex_filename.rsplit(".", 1)[0] + ".pdf"
             pdf_path = os.path.join(tex_dir, pdf_filename)
 
-            # Tectonic uses XeTeX which lacks \pdfglyphtounicode. Drop a local
-            # stub that defines it as a no-op so tectonic doesn't choke on it.
-            stub_path = os.path.join(tex_dir, "glyphtounicode.tex")
-            stub_created = not os.path.exists(stub_path)
-            if stub_created:
-                with open(stub_path, "w") as f:
-                    f.write(r"\ifx\pdfglyphtounicode\undefined\def\pdfglyphtounicode#1#2{}\fi" + "\n")
-
-            try:
-                result = subprocess.run(
-                    [tectonic, "-Z", "continue-on-errors", tex_filename],
-                    cwd=tex_dir,
-                    capture_output=True,
-                    text=True,
-                    timeout=120,
-                )
-            finally:
-                if stub_created and os.path.exists(stub_path):
-                    os.remove(stub_path)
+            st = os.stat(full_path)
+            with _tex_cache_lock:
+                cached = _tex_cache.get(full_path)
+            if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                digest = cached[2]
+            else:
+                digest = _sha256_file(full_path)
+
+            # Unchanged source and a PDF newer than everything it was built
+            # from: hand back the existing PDF without running tectonic.
+            if cached and cached[2] == digest and cached[3] == pdf_path:
+                try:
+                    pdf_mtime = os.stat(pdf_path).st_mtime_ns
+                except FileNotFoundError:
+                    pdf_mtime = -1
+                # A matching hash means the main file's content is what was
+                # compiled, so a bare touch doesn't count against the PDF.
+                deps_mtime = _newest_mtime(cached[4])
+                if deps_mtime is not None and pdf_mtime >= max(cached[0], deps_mtime):
+                    with _tex_cache_lock:
+                        _tex_cache[full_path] = (st.st_mtime_ns, st.st_size, digest, pdf_path, cached[4])
+                    rel_pdf_path = os.path.relpath(pdf_path, self.base_dir)
+                    self.send_json_response({"success": True, "pdf_url": "/" + quote(rel_pdf_path)})
+                    return
+
+            # Compiles run on a bounded pool so a burst of renders can't
+            # start more tectonic processes than there are CPUs.
+            result, deps = _RENDER_POOL.submit(
+                _run_tectonic, tectonic, tex_dir, tex_filename, pdf_path
+            ).result()
 
             if result.returncode != 0 or not os.path.exists(pdf_path):
                 error_msg = result.stderr or result.stdout or "tectonic compilation failed"
                 self.send_json_response({"success": False, "error": error_msg[-800:]})
                 return
 
+            # Without a dependency list there's no safe way to reuse the PDF
+            if deps is not None:
+                main_tex = os.path.realpath(full_path)
+                deps = tuple(dep for dep in deps if dep != main_tex)
+                with _tex_cache_lock:
+                    _tex_cache[full_path] = (st.st_mtime_ns, st.st_size, digest, pdf_path, deps)
+
             rel_pdf_path = os.path.relpath(pdf_path, self.base_dir)
             self.send_json_response({
                 "success": True,
@@ -256,59 +701,89 @@ class FileServerHandler(SimpleHTTPRequestHandler):
             self.send_json_response({"success": False, "error": str(e)})
 
     def send_json_response(self, data):
+        self.send_json_bytes(_dumps(data))
+
+    def send_json_bytes(self, body):
+        self._send_bytes(body, "application/json")
+
+    def send_json_entry(self, entry):
+        """Send the JSON body in entry[0], gzipped when the client accepts it.
+
+        The compressed body is computed once and kept in entry[1], so cached
+        responses are only compressed on their first gzip hit.
+        """
+        body = entry[0]
+        if len(body) < GZIP_MIN_BYTES or "gzip" not in self.headers.get("Accept-Encoding", ""):
+            self._send_bytes(body, "application/json", [("Vary", "Accept-Encoding")])
+            return
+        if entry[1] is None:
+            # Level 1: most of the size win on source text for little CPU
+            _entry_set_gzip(entry, gzip.compress(body, compresslevel=1))
+        headers = [("Vary", "Accept-Encoding"), ("Content-Encoding", "gzip")]
+        self._send_bytes(entry[1], "application/json", headers)
+
+    def _send_bytes(self, body, content_type, headers=()):
+        """Send a 200 response carrying body; wbufsize coalesces it with the headers."""
         self.send_response(200)
-        self.send_header("Content-type", "application/json")
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", len(body))
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_modified(self, etag):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def send_empty_response(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
 
     def handle_confirm_selection(self):
         content_length = int(self.headers.get("Content-Length", "0"))
         post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode("utf-8"))
-
-        print("\n" + "=" * 60)
-        print("SELECTION CONFIRMED")
-        print("=" * 60)
-        print(f"File: {data.get('file_path', '')}")
-        print(f"Lines: {data.get('start_line', '')}-{data.get('end_line', '')}")
-        print("-" * 60)
-        print(data.get("selected_text", ""))
-        print("=" * 60 + "\n")
+        data = _loads(post_data)
+
+        _print_async(
+            "\n".join(
+                [
+                    "\n" + "=" * 60,
+                    "SELECTION CONFIRMED",
+                    "=" * 60,
+                    f"File: {data.get('file_path', '')}",
+                    f"Lines: {data.get('start_line', '')}-{data.get('end_line', '')}",
+                    "-" * 60,
+                    str(data.get("selected_text", "")),
+                    "=" * 60 + "\n",
+                ]
+            )
+        )
 
         # Save selection to state file for MCP server
-        import time
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            existing_state = {}
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    existing_state = json.load(f)
-
-            existing_state["selection"] = {
-                "file_path": data.get("file_path", ""),
-                "start_line": data.get("start_line", 0),
-                "end_line": data.get("end_line", 0),
-                "selected_text": data.get("selected_text", ""),
-                "voice_query": data.get("voice_query", ""),
-                "timestamp": time.time(),
-            }
-
-            with open(state_file, "w") as f:
-                json.dump(existing_state, f, indent=2)
+            with _state_lock, state_file.lock():
+                existing_state = _load_state()
+                existing_state["selection"] = {
+                    "file_path": data.get("file_path", ""),
+                    "start_line": data.get("start_line", 0),
+                    "end_line": data.get("end_line", 0),
+                    "selected_text": data.get("selected_text", ""),
+                    "voice_query": data.get("voice_query", ""),
+                    "timestamp": time.time(),
+                }
+                state_file.save(existing_state)
         except Exception as e:
-            print(f"Warning: Failed to save selection state: {e}")
+            _print_async(f"Warning: Failed to save selection state: {e}")
 
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
+        self.send_json_response({"status": "ok"})
 
     def handle_file_mtime_api(self):
         try:
-            path = unquote(self.path.replace("/api/file-mtime", "", 1)).lstrip("/")
-            full_path = os.path.join(self.base_dir, path)
-            full_path = os.path.normpath(full_path)
-            if not full_path.startswith(self.base_dir):
+            _, full_path = self.resolve_request_path("/api/file-mtime")
+            if not _is_within(full_path, self._base_dir_prefix):
                 self.send_error(403)
                 return
             if not os.path.isfile(full_path):
@@ -320,81 +795,56 @@ class FileServerHandler(SimpleHTTPRequestHandler):
 
     def handle_navigation_state_api(self):
         """Return current navigation state from state file."""
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    state = json.load(f)
-            else:
-                state = {}
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(state).encode("utf-8"))
+            self.send_json_response(_load_state())
         except Exception as e:
-            print(f"Error reading navigation state: {e}")
+            _print_async(f"Error reading navigation state: {e}")
             self.send_json_response({})
 
     def handle_navigation_executed(self):
         """Mark navigation command as executed."""
         content_length = int(self.headers.get("Content-Length", "0"))
         post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode("utf-8"))
+        data = _loads(post_data)
 
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            existing_state = {}
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    existing_state = json.load(f)
-
-            # Mark navigation as executed if timestamps match
-            if "navigation" in existing_state:
-                if existing_state["navigation"].get("timestamp") == data.get("timestamp"):
+            with _state_lock, state_file.lock():
+                existing_state = _load_state()
+                # Mark navigation as executed if timestamps match
+                executed = (
+                    "navigation" in existing_state
+                    and existing_state["navigation"].get("timestamp") == data.get("timestamp")
+                )
+                if executed:
                     existing_state["navigation"]["executed"] = True
+                    state_file.save(existing_state)
 
-                    with open(state_file, "w") as f:
-                        json.dump(existing_state, f, indent=2)
+            if executed:
+                _print_async(f"\nNavigation executed: {existing_state['navigation']['command']} to {existing_state['navigation']['file_path']}\n")
 
-                    print(f"\nNavigation executed: {existing_state['navigation']['command']} to {existing_state['navigation']['file_path']}\n")
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
+            self.send_json_response({"status": "ok"})
         except Exception as e:
-            print(f"Error marking navigation as executed: {e}")
-            self.send_response(500)
-            self.end_headers()
+            _print_async(f"Error marking navigation as executed: {e}")
+            self.send_empty_response(500)
 
     def handle_voice_spoken(self):
         """Mark voice_response as spoken so the browser doesn't replay it."""
         content_length = int(self.headers.get("Content-Length", "0"))
         post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode("utf-8"))
+        data = _loads(post_data)
 
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            existing_state = {}
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    existing_state = json.load(f)
-
-            if "voice_response" in existing_state:
-                if existing_state["voice_response"].get("timestamp") == data.get("timestamp"):
-                    existing_state["voice_response"]["spoken"] = True
-                    with open(state_file, "w") as f:
-                        json.dump(existing_state, f, indent=2)
-
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
+            with _state_lock, state_file.lock():
+                existing_state = _load_state()
+                if "voice_response" in existing_state:
+                    if existing_state["voice_response"].get("timestamp") == data.get("timestamp"):
+                        existing_state["voice_response"]["spoken"] = True
+                        state_file.save(existing_state)
+
+            self.send_json_response({"status": "ok"})
         except Exception as e:
-            print(f"Error marking voice response as spoken: {e}")
-            self.send_response(500)
-            self.end_headers()
+            _print_async(f"Error marking voice response as spoken: {e}")
+            self.send_empty_response(500)
 
     def handle_annotations_api(self):
         """Return annotations, optionally filtered by file path."""
@@ -402,14 +852,8 @@ class FileServerHandler(SimpleHTTPRequestHandler):
         params = parse_qs(parsed.query)
         file_filter = params.get("file", [None])[0]
 
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            state = {}
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    state = json.load(f)
-
-            annotations = state.get("annotations", [])
+            annotations = _load_state().get("annotations", [])
 
             if file_filter:
                 file_filter_decoded = unquote(file_filter)
@@ -418,55 +862,56 @@ class FileServerHandler(SimpleHTTPRequestHandler):
                     if unquote(a.get("file_path", "")) == file_filter_decoded
                 ]
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(annotations).encode("utf-8"))
+            self.send_json_response(annotations)
         except Exception:
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(b"[]")
+            self.send_json_response([])
 
     def handle_delete_annotation(self):
         """Delete an annotation by id."""
         content_length = int(self.headers.get("Content-Length", "0"))
         post_data = self.rfile.read(content_length)
-        data = json.loads(post_data.decode("utf-8"))
+        data = _loads(post_data)
         annotation_id = data.get("id")
 
-        state_file = Path.home() / ".context-viewer-state.json"
         try:
-            existing_state = {}
-            if state_file.exists():
-                with open(state_file, "r") as f:
-                    existing_state = json.load(f)
+            with _state_lock, state_file.lock():
+                existing_state = _load_state()
+                annotations = existing_state.get("annotations", [])
+                existing_state["annotations"] = [
+                    a for a in annotations if a.get("id") != annotation_id
+                ]
+                state_file.save(existing_state)
 
-            annotations = existing_state.get("annotations", [])
-            existing_state["annotations"] = [
-                a for a in annotations if a.get("id") != annotation_id
-            ]
+            self.send_json_response({"status": "ok"})
+        except Exception as e:
+            _print_async(f"Error deleting annotation: {e}")
+            self.send_empty_response(500)
 
-            with open(state_file, "w") as f:
-                json.dump(existing_state, f, indent=2)
 
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"status": "ok"}).encode("utf-8"))
-        except Exception as e:
-            print(f"Error deleting annotation: {e}")
-            self.send_response(500)
-            self.end_headers()
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that serves at most max_workers connections at once.
+
+    Handler threads stay daemonic, so an idle keep-alive connection never
+    delays shutdown; further connections wait in the listen backlog.
+    """
 
-    def get_html(self):
-        static_dir = os.path.join(os.path.dirname(__file__), "static")
-        index_path = os.path.join(static_dir, "index.html")
+    def __init__(self, server_address, handler_class, max_workers: int):
+        super().__init__(server_address, handler_class)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
         try:
-            with open(index_path, "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            return "<html><body><h1>Error: index.html not found in static directory</h1></body></html>"
+            super().process_request(request, client_address)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
 
 
 if __name__ == "__main__":
@@ -477,12 +922,19 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     port = args.port
-    FileServerHandler.base_dir = os.path.abspath(args.serve_dir)
+    FileServerHandler.base_dir = os.path.realpath(args.serve_dir)
+    FileServerHandler._base_dir_prefix = os.path.join(FileServerHandler.base_dir, "")
 
-    server = HTTPServer(("localhost", port), FileServerHandler)
+    max_workers = int(os.environ.get("CONTEXTVIEWER_MAX_WORKERS", "32"))
+    server = BoundedThreadingHTTPServer(("localhost", port), FileServerHandler, max_workers)
     print(f"Server running at http://localhost:{port}")
     print(f"Serving files from: {FileServerHandler.base_dir}")
+    printer = threading.Thread(target=_print_worker, name="print", daemon=True)
+    printer.start()
     try:
         server.serve_forever()
     except KeyboardInterrupt:
-        print("\nServer stopped")
+        _print_async("\nServer stopped")
+    finally:
+        _print_queue.put(None)
+        printer.join()
@@ -0,0 +1,80 @@
+"""State-file protocol shared by server.py and mcp_server.py.
+
+Both servers read and replace the same JSON file, so its location, lock,
+encoding and atomic-replace steps live here and cannot drift apart.
+"""
+
+import contextlib
+import json
+import os
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # optional: faster state-file (de)serialization
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows: cross-process state locking is skipped
+    fcntl = None  # type: ignore[assignment]
+
+STATE_FILE = Path(
+    os.environ.get("CONTEXTVIEWER_STATE_FILE") or Path.home() / ".context-viewer-state.json"
+).expanduser()
+
+
+def dumps(state: dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(state)
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@contextlib.contextmanager
+def lock() -> Iterator[None]:
+    """Hold an exclusive advisory lock for a read-modify-write of STATE_FILE.
+
+    The state file itself is replaced on every save, so the lock lives on a
+    sidecar file that survives the rename.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(STATE_FILE.with_name(STATE_FILE.name + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def fsync_dir(path: Path) -> None:
+    """Flush a directory entry so a preceding rename survives a crash."""
+    if not hasattr(os, "O_DIRECTORY"):  # e.g. Windows
+        return
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_temp(payload: bytes) -> Path:
+    """Write payload durably next to STATE_FILE and return the temp path to rename."""
+    temp_file = STATE_FILE.with_name(STATE_FILE.name + ".tmp")
+    with open(temp_file, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    return temp_file
+
+
+def save(state: dict[str, Any]) -> None:
+    """Replace STATE_FILE with state atomically and durably; caller holds lock()."""
+    os.replace(write_temp(dumps(state)), STATE_FILE)
+    fsync_dir(STATE_FILE.parent)
@@ -2,9 +2,15 @@ let currentPath = '';
 let currentFile = '';
 let currentFilePath = '';
 let currentFileLines = [];
-let selectedLines = new Set();
+let selectedLines = null;  // LineSelection, created below
+let lineElements = [];  // lineElements[n - 1] is the .line div for line n
+let selectionInfoEl = null;
 let isDragging = false;
 let dragStartLine = null;
+let dragEndLine = null;
+let dragFrom = 0;
+let dragTo = 0;
+let dragFrame = null;
 let lastClickedLine = null;
 let activeTreePath = '';
 let activeTreeIsDir = false;
@@ -235,8 +241,9 @@ async function loadFile(path, name) {
         currentFile = name;
         currentFilePath = path;
         currentFileLines = (data.content || '').split('\n');
+        lineElements = [];
         displayFile(data, name);
-        selectedLines.clear();
+        selectedLines.reset(currentFileLines.length);
         lastClickedLine = null;
         updateSelectionInfo();
         loadAnnotations(path);
@@ -273,15 +280,16 @@ async function reloadCurrentFile() {
     if (!currentFilePath || !currentFile) return;
     const contentEl = document.getElementById('content');
     const scrollTop = contentEl ? contentEl.scrollTop : 0;
-    const prevSelected = new Set(selectedLines);
+    const prevSelected = Array.from(selectedLines);
     try {
         const res = await fetch('/api/file-content/' + currentFilePath);
         const data = await res.json();
         currentFileLines = (data.content || '').split('\n');
         displayFile(data, currentFile);
+        selectedLines.reset(currentFileLines.length);
         // restore selection highlights
         prevSelected.forEach(ln => {
-            const el = document.querySelector(`[data-line="${ln}"]`);
+            const el = getLineEl(ln);
             if (el) { el.classList.add('selected'); selectedLines.add(ln); }
         });
         updateSelectionInfo();
@@ -372,10 +380,64 @@ function getLanguageFromFilename(filename) {
     return langMap[ext] || null;
 }
 
+// Highlighted output of recently viewed files, keyed by path and reused while
+// the content is unchanged (reopening a file, or a reload with no edits).
+// Bounded by entry count and by total characters held (source + HTML).
+const highlightCache = new Map();
+const HIGHLIGHT_CACHE_MAX = 20;
+const HIGHLIGHT_CACHE_MAX_CHARS = 16 * 1024 * 1024;
+let highlightCacheChars = 0;
+
+function highlightCode(content, name) {
+    if (typeof hljs === 'undefined') return escapeHtml(content);
+    const language = getLanguageFromFilename(name);
+    try {
+        if (language) {
+            return hljs.highlight(content, { language: language }).value;
+        }
+        return hljs.highlightAuto(content).value;
+    } catch (e) {
+        try {
+            return hljs.highlightAuto(content).value;
+        } catch (e2) {
+            return escapeHtml(content);
+        }
+    }
+}
+
+function getHighlightedLines(key, name, content) {
+    const cached = highlightCache.get(key);
+    if (cached && cached.content === content) {
+        // refresh recency
+        highlightCache.delete(key);
+        highlightCache.set(key, cached);
+        return cached.lines;
+    }
+    const html = highlightCode(content, name);
+    const lines = html.split('\n');
+    dropHighlightEntry(key);
+    const chars = content.length + html.length;
+    if (chars > HIGHLIGHT_CACHE_MAX_CHARS) return lines;
+    highlightCache.set(key, { content, lines, chars });
+    highlightCacheChars += chars;
+    while (highlightCache.size > HIGHLIGHT_CACHE_MAX || highlightCacheChars > HIGHLIGHT_CACHE_MAX_CHARS) {
+        dropHighlightEntry(highlightCache.keys().next().value);
+    }
+    return lines;
+}
+
+function dropHighlightEntry(key) {
+    const entry = highlightCache.get(key);
+    if (!entry) return;
+    highlightCacheChars -= entry.chars;
+    highlightCache.delete(key);
+}
+
 function displayFile(data, name) {
     const content = document.getElementById('content');
     const isTexFile = name.toLowerCase().endsWith('.tex');
     currentIsPdf = false;
+    lineElements = [];
 
     if (!data.is_text) {
         const mime = data.mime_type || '';
@@ -395,7 +457,6 @@ function displayFile(data, name) {
     }
 
     currentTexView = 'source';
-    const lines = data.content.split('\n');
     let html = '';
 
     if (isTexFile) {
@@ -405,61 +466,86 @@ function displayFile(data, name) {
         </div>`;
     }
 
-    const language = getLanguageFromFilename(name);
-    let highlightedCode = '';
+    const highlightedLines = getHighlightedLines(currentFilePath || name, name, data.content);
 
-    if (typeof hljs !== 'undefined') {
-        try {
-            if (language) {
-                const highlighted = hljs.highlight(data.content, { language: language });
-                highlightedCode = highlighted.value;
-            } else {
-                const highlighted = hljs.highlightAuto(data.content);
-                highlightedCode = highlighted.value;
-            }
-        } catch (e) {
-            try {
-                const highlighted = hljs.highlightAuto(data.content);
-                highlightedCode = highlighted.value;
-            } catch (e2) {
-                highlightedCode = escapeHtml(data.content);
-            }
-        }
-    } else {
-        highlightedCode = escapeHtml(data.content);
+    html += `<div class="file-preview"><div class="file-name">${name}</div><div id="texContent" style="background: #151515; border-radius: 12px; border: 1px solid rgba(255,255,255,0.05); box-shadow: 0 10px 30px rgba(0,0,0,0.4); overflow: hidden;">`;
+    html += highlightedLines.map((line, idx) => {
+        const lineNum = idx + 1;
+        return `<div class="line" data-line="${lineNum}"><span class="line-number">${lineNum}</span><span class="line-content">${line}</span></div>`;
+    }).join('');
+    html += '</div>';
+    if (data.truncated) {
+        html += `<div class="truncated-notice">File too large to preview in full; showing the first ${highlightedLines.length} lines. <a href="${data.file_url}" target="_blank" style="color:#4aa3ff;">Open raw file</a></div>`;
     }
+    html += '</div>';
+    content.innerHTML = html;
 
-    const highlightedLines = highlightedCode.split('\n');
+    lineElements = Array.from(content.querySelectorAll('.line'));
+    // Stash the number on the element so mouse handlers skip parseInt
+    lineElements.forEach((el, i) => { el._ln = i + 1; });
 
-    html += `<div class="file-preview"><div class="file-name">${name}</div><div id="texContent" style="background: #151515; border-radius: 12px; border: 1px solid rgba(255,255,255,0.05); box-shadow: 0 10px 30px rgba(0,0,0,0.4); overflow: hidden;">`;
-    highlightedLines.forEach((line, idx) => {
-        const lineNum = idx + 1;
-        const displayLine = line || '';
-        html += `<div class="line" data-line="${lineNum}" onclick="handleLineClick(${lineNum}, event)" style="cursor: pointer;"><span class="line-number">${lineNum}</span><span class="line-content">${displayLine}</span></div>`;
+    // One set of listeners on the listing instead of one per line
+    const listing = document.getElementById('texContent');
+    const lineFromEvent = (e) => {
+        const el = e.target.closest('.line');
+        return el ? el._ln : 0;
+    };
+    listing.addEventListener('click', (e) => {
+        const lineNum = lineFromEvent(e);
+        if (!lineNum) return;
+        handleLineClick(lineNum, e);
     });
-    html += '</div></div>';
-    content.innerHTML = html;
+    listing.addEventListener('mousedown', (e) => {
+        const lineNum = lineFromEvent(e);
+        if (!lineNum) return;
+        if (!e.shiftKey && !e.metaKey && !e.ctrlKey && !e.altKey) {
+            clearSelection();
+        }
+        isDragging = true;
+        dragStartLine = lineNum;
+        setRangeSelection(lineNum, lineNum, true);
+        dragFrom = dragTo = lineNum;
+        e.preventDefault();
+    });
+    listing.addEventListener('mouseover', (e) => {
+        if (!isDragging || dragStartLine === null) return;
+        const lineNum = lineFromEvent(e);
+        if (!lineNum) return;
+        dragEndLine = lineNum;
+        if (dragFrame === null) dragFrame = requestAnimationFrame(applyDragSelection);
+    });
+}
 
-    const lineEls = content.querySelectorAll('.line');
-    lineEls.forEach(el => {
-        el.addEventListener('mousedown', (e) => {
-            const lineNum = parseInt(el.dataset.line, 10);
-            if (Number.isNaN(lineNum)) return;
-            if (!e.shiftKey && !e.metaKey && !e.ctrlKey && !e.altKey) {
-                clearSelection();
+// At most one drag update per frame. During a drag the selection is exactly
+// [dragFrom, dragTo], so only rows entering or leaving that range are touched.
+function applyDragSelection() {
+    dragFrame = null;
+    if (!isDragging || dragStartLine === null || dragEndLine === null) return;
+    const from = Math.min(dragStartLine, dragEndLine);
+    const to   = Math.max(dragStartLine, dragEndLine);
+    const unmark = (a, b) => {
+        for (let ln = a; ln <= b; ln++) {
+            selectedLines.delete(ln);
+            const el = getLineEl(ln);
+            if (el) el.classList.remove('selected');
+        }
+    };
+    const mark = (a, b) => {
+        for (let ln = a; ln <= b; ln++) {
+            const el = getLineEl(ln);
+            if (el) {
+                selectedLines.add(ln);
+                el.classList.add('selected');
             }
-            isDragging = true;
-            dragStartLine = lineNum;
-            setRangeSelection(lineNum, lineNum, true);
-            e.preventDefault();
-        });
-        el.addEventListener('mouseover', () => {
-            if (!isDragging || dragStartLine === null) return;
-            const lineNum = parseInt(el.dataset.line, 10);
-            if (Number.isNaN(lineNum)) return;
-            setRangeSelection(dragStartLine, lineNum, true);
-        });
-    });
+        }
+    };
+    unmark(dragFrom, Math.min(dragTo, from - 1));
+    unmark(Math.max(dragFrom, to + 1), dragTo);
+    mark(from, Math.min(to, dragFrom - 1));
+    mark(Math.max(from, dragTo + 1), to);
+    dragFrom = from;
+    dragTo = to;
+    updateSelectionInfo();
 }
 
 // ─── PDF viewer ───────────────────────────────────────────────────────────────
@@ -576,6 +662,74 @@ function _renderPdfIframe(url) {
 
 // ─── Line interaction ─────────────────────────────────────────────────────────
 
+// Selected line numbers kept as a dense 0/1 array indexed by line number.
+// Mirrors the Set methods the viewer uses, but iterates in ascending order,
+// so callers never have to sort.
+class LineSelection {
+    constructor(lineCount = 0) {
+        this.bits = new Uint8Array(lineCount + 1);
+        this.size = 0;
+    }
+
+    reset(lineCount) {
+        this.bits = new Uint8Array(lineCount + 1);
+        this.size = 0;
+    }
+
+    has(lineNum) {
+        return this.bits[lineNum] === 1;
+    }
+
+    add(lineNum) {
+        if (lineNum >= this.bits.length) {
+            const grown = new Uint8Array(lineNum + 1);
+            grown.set(this.bits);
+            this.bits = grown;
+        }
+        if (!this.bits[lineNum]) {
+            this.bits[lineNum] = 1;
+            this.size++;
+        }
+    }
+
+    delete(lineNum) {
+        if (this.bits[lineNum]) {
+            this.bits[lineNum] = 0;
+            this.size--;
+        }
+    }
+
+    clear() {
+        if (this.size) this.bits.fill(0);
+        this.size = 0;
+    }
+
+    first() {
+        if (!this.size) return null;
+        return this.bits.indexOf(1);
+    }
+
+    last() {
+        if (!this.size) return null;
+        return this.bits.lastIndexOf(1);
+    }
+
+    forEach(fn) {
+        for (const lineNum of this) fn(lineNum);
+    }
+
+    *[Symbol.iterator]() {
+        if (!this.size) return;
+        const bits = this.bits;
+        for (let ln = this.first(), last = this.last(); ln <= last; ln++) {
+            if (bits[ln]) yield ln;
+        }
+    }
+}
+
+selectedLines = new LineSelection();
+
+
 function handleLineClick(lineNum, event) {
     event.stopPropagation();
     if (event.altKey) {
@@ -597,20 +751,25 @@ function handleLineClick(lineNum, event) {
     updateSelectionInfo();
 }
 
+const HTML_ESCAPES = { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' };
+const HTML_ESCAPE_TEST = /[&<>"']/;
+const HTML_ESCAPE_RE = /[&<>"']/g;
+
 function escapeHtml(text) {
-    if (typeof hljs !== 'undefined' && hljs.utils && hljs.utils.escapeHtml) {
-        return hljs.utils.escapeHtml(text);
-    }
-    return text
-        .replace(/&/g, '&amp;')
-        .replace(/</g, '&lt;')
-        .replace(/>/g, '&gt;')
-        .replace(/"/g, '&quot;')
-        .replace(/'/g, '&#39;');
+    // One pass over the string, and none at all when nothing needs escaping
+    if (!HTML_ESCAPE_TEST.test(text)) return text;
+    return text.replace(HTML_ESCAPE_RE, c => HTML_ESCAPES[c]);
+}
+
+// Views that replace the source listing (PDF, rendered TeX) detach the old
+// rows, so only hand back elements that are still in the document.
+function getLineEl(lineNum) {
+    const el = lineElements[lineNum - 1];
+    return el && el.isConnected ? el : null;
 }
 
 function toggleLine(lineNum) {
-    const lineEl = document.querySelector(`[data-line="${lineNum}"]`);
+    const lineEl = getLineEl(lineNum);
     if (!lineEl) return;
     if (selectedLines.has(lineNum)) {
         selectedLines.delete(lineNum);
@@ -628,7 +787,7 @@ function setRangeSelection(start, end, replace) {
         clearSelection();
     }
     for (let ln = from; ln <= to; ln++) {
-        const lineEl = document.querySelector(`[data-line="${ln}"]`);
+        const lineEl = getLineEl(ln);
         if (lineEl) {
             selectedLines.add(ln);
             lineEl.classList.add('selected');
@@ -650,35 +809,46 @@ function selectParagraph(lineNum) {
     setRangeSelection(start, end, true);
 }
 
+// Count leading spaces/tabs without allocating a match
+function leadingIndent(s) {
+    let i = 0;
+    while (i < s.length) {
+        const c = s.charCodeAt(i);
+        if (c !== 32 && c !== 9) break;
+        i++;
+    }
+    return i;
+}
+
 function selectIndentBlock(lineNum) {
     if (!currentFileLines.length) return;
     const lineText = currentFileLines[lineNum - 1] || '';
     if (lineText.trim() === '') return;
-    const baseIndent = lineText.match(/^\s*/)[0].length;
+    const baseIndent = leadingIndent(lineText);
     let start = lineNum;
     let end   = lineNum;
     while (start > 1) {
         const prev = currentFileLines[start - 2];
         if (prev.trim() === '') { start -= 1; continue; }
-        if (prev.match(/^\s*/)[0].length < baseIndent) break;
+        if (leadingIndent(prev) < baseIndent) break;
         start -= 1;
     }
     while (end < currentFileLines.length) {
         const next = currentFileLines[end];
         if (next.trim() === '') { end += 1; continue; }
-        if (next.match(/^\s*/)[0].length < baseIndent) break;
+        if (leadingIndent(next) < baseIndent) break;
         end += 1;
     }
     setRangeSelection(start, end, true);
 }
 
 function updateSelectionInfo() {
-    const info = document.getElementById('selectionInfo');
+    if (!selectionInfoEl) selectionInfoEl = document.getElementById('selectionInfo');
+    const info = selectionInfoEl;
     if (selectedLines.size === 0) {
         info.textContent = '';
     } else {
-        const sorted = Array.from(selectedLines).sort((a, b) => a - b);
-        info.textContent = `${selectedLines.size} line(s) selected (${sorted[0]}-${sorted[sorted.length - 1]})`;
+        info.textContent = `${selectedLines.size} line(s) selected (${selectedLines.first()}-${selectedLines.last()})`;
     }
     scheduleAutoSave();
 }
@@ -692,7 +862,7 @@ function scheduleAutoSave() {
 
 async function autoSaveSelection() {
     if (!currentFilePath && !currentFile) return;
-    const lines = Array.from(selectedLines).sort((a, b) => a - b);
+    const lines = Array.from(selectedLines);
     const selectedText = lines.map(ln => currentFileLines[ln - 1] ?? '').join('\n');
     await fetch('/api/confirm-selection', {
         method: 'POST',
@@ -709,7 +879,7 @@ async function autoSaveSelection() {
 
 function clearSelection() {
     selectedLines.forEach(ln => {
-        const el = document.querySelector(`[data-line="${ln}"]`);
+        const el = getLineEl(ln);
         if (el) el.classList.remove('selected');
     });
     selectedLines.clear();
@@ -785,7 +955,7 @@ async function confirmSelection() {
             }
         }
         if (selectedLines.size === 0) return;
-        const lines = Array.from(selectedLines).sort((a, b) => a - b);
+        const lines = Array.from(selectedLines);
         selectedText = lines.map(ln => currentFileLines[ln - 1] ?? '').join('\n');
         startLine = lines[0];
         endLine = lines[lines.length - 1];
@@ -932,7 +1102,7 @@ async function executeNavigationCommand(nav) {
 }
 
 function navigateToLine(lineNum) {
-    const lineEl = document.querySelector(`[data-line="${lineNum}"]`);
+    const lineEl = getLineEl(lineNum);
     if (!lineEl) return;
 
     clearSelection();
@@ -1015,7 +1185,7 @@ function renderAnnotations() {
         const start = ann.start_line || 0;
         const end = ann.end_line || start;
         for (let ln = start; ln <= end; ln++) {
-            const lineEl = document.querySelector(`[data-line="${ln}"]`);
+            const lineEl = getLineEl(ln);
             if (lineEl) {
                 const numEl = lineEl.querySelector('.line-number');
                 if (numEl && !numEl.querySelector('.annotation-dot')) {
@@ -1037,7 +1207,7 @@ function renderAnnotations() {
     }
 
     for (const [endLine, anns] of Object.entries(byEndLine)) {
-        const lineEl = document.querySelector(`[data-line="${endLine}"]`);
+        const lineEl = getLineEl(Number(endLine));
         if (!lineEl || !lineEl.parentNode) continue;
 
         let lastInserted = lineEl;
@@ -1084,8 +1254,13 @@ async function deleteAnnotation(id) {
 
 document.addEventListener('DOMContentLoaded', () => {
     document.addEventListener('mouseup', () => {
+        if (dragFrame !== null) {
+            cancelAnimationFrame(dragFrame);
+            applyDragSelection();
+        }
         isDragging    = false;
         dragStartLine = null;
+        dragEndLine   = null;
     });
     // For PDFs, watch native text selection to update the info bar and cache it.
     document.addEventListener('selectionchange', () => {
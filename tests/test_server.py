@@ -0,0 +1,72 @@
+import os
+import unittest
+from unittest import mock
+
+import server
+from server import _makefile_rule_inputs, _parse_range
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_whole_file_without_usable_header(self):
+        self.assertIsNone(_parse_range(None, 100))
+        self.assertIsNone(_parse_range("bytes=0-1,5-6", 100))
+        self.assertIsNone(_parse_range("bytes=a-b", 100))
+
+    def test_ranges(self):
+        self.assertEqual(_parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(_parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=90-500", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(_parse_range("bytes=-500", 100), (0, 99))
+
+    def test_unsatisfiable(self):
+        self.assertIs(_parse_range("bytes=100-", 100), False)
+        self.assertIs(_parse_range("bytes=-0", 100), False)
+
+    def test_suffix_range_of_empty_file_is_unsatisfiable(self):
+        self.assertIs(_parse_range("bytes=-5", 0), False)
+        self.assertIs(_parse_range("bytes=0-", 0), False)
+
+    def test_invalid_range_is_ignored(self):
+        self.assertIsNone(_parse_range("bytes=5-3", 100))
+
+
+class MakefileRuleInputsTest(unittest.TestCase):
+    def test_prerequisites_are_resolved_against_the_build_dir(self):
+        rules = "out/main.pdf: main.tex sections/intro.tex \\\n  figs/my\\ plot.png\n"
+        root = os.path.realpath("/srv/doc")
+        self.assertEqual(
+            _makefile_rule_inputs(rules, root),
+            [
+                os.path.join(root, "main.tex"),
+                os.path.join(root, "sections", "intro.tex"),
+                os.path.join(root, "figs", "my plot.png"),
+            ],
+        )
+
+    def test_lines_without_a_rule_are_ignored(self):
+        self.assertEqual(_makefile_rule_inputs("# comment\n\n", "/"), [])
+
+
+class ResponseCacheTest(unittest.TestCase):
+    @mock.patch.object(server, "RESPONSE_CACHE_MAX_BYTES", 100)
+    def test_evicts_least_recent_entries_over_the_byte_budget(self):
+        cache = server._ResponseCache()
+        first = server._cache_put(cache, "a", 1, b"x" * 40)
+        server._cache_put(cache, "b", 1, b"y" * 40)
+        self.assertEqual(cache.nbytes, 80)
+
+        # The gzipped copy counts too, pushing the cache over budget
+        server._entry_set_gzip(first, b"z" * 30)
+        self.assertEqual(list(cache.entries), ["b"])
+        self.assertEqual(cache.nbytes, 40)
+
+    def test_expired_entries_release_their_bytes(self):
+        cache = server._ResponseCache()
+        server._cache_put(cache, "a", 1, b"x" * 10)
+        self.assertIsNone(server._cache_get(cache, "a", 2))
+        self.assertEqual(cache.nbytes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import server
+import state_file
+
+try:
+    import mcp_server
+except ImportError:  # the MCP SDK is not installed
+    mcp_server = None
+
+
+def _browser_save(**changes):
+    """Save the way server.py's state handlers do: read, modify, replace under the lock."""
+    with state_file.lock():
+        state = server._load_state()
+        state.update(changes)
+        state_file.save(state)
+
+
+@unittest.skipIf(mcp_server is None, "mcp is not installed")
+class StateMergeTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patches = [
+            mock.patch.object(state_file, "STATE_FILE", Path(tmp.name) / "state.json"),
+            mock.patch.dict(mcp_server._STATE_CACHE, {"key": None, "value": {}}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def test_browser_save_before_flush_is_kept(self):
+        navigation = {"file": "a.py", "line": 3}
+        mcp_server.schedule_state_update(lambda state: state.update(navigation=navigation))
+        _browser_save(annotations=[{"id": 1}])
+
+        self.assertEqual(mcp_server.get_state()["annotations"], [{"id": 1}])
+        self.assertEqual(mcp_server.get_state()["navigation"], navigation)
+
+        mcp_server.flush_state()
+        self.assertEqual(server._load_state(), {"annotations": [{"id": 1}], "navigation": navigation})
+
+    async def test_drop_selection_keeps_a_newer_selection(self):
+        selection = {
+            "file_path": "a.py",
+            "start_line": 1,
+            "end_line": 2,
+            "selected_text": "x",
+            "timestamp": 1,
+        }
+        _browser_save(selection=selection)
+        mcp_server.schedule_state_update(mcp_server._drop_selection(selection))
+        newer = dict(selection, timestamp=2)
+        _browser_save(selection=newer)
+
+        mcp_server.flush_state()
+        self.assertEqual(server._load_state()["selection"], newer)
+
+        mcp_server.schedule_state_update(mcp_server._drop_selection(newer))
+        mcp_server.flush_state()
+        self.assertNotIn("selection", server._load_state())
+
+
+if __name__ == "__main__":
+    unittest.main()